@@ -658,10 +658,8 @@ function __build_plot() {
 }
 
 function __process_measurements() {
-    local callparser="$1"
-    local measfile=$BUILD_NUMBER.measurements.hottest.txt
+    local measfile="$1"
     local lastbuildfile=$__PERSISTENT_JOB_DIR/last-build
-    $callparser -t meas > "$measfile"
     if [[ ! -f "$measfile" ]]; then
         return 0
     fi
@@ -717,13 +715,15 @@ function __process_measurements() {
 }
 
 function __process_test_results() {
-    local callparser="$1"
+    local measfile="$1"
     echo "Test results:"
-    $callparser -t human
-    $callparser -t xunit > $BUILD_NUMBER.results.xunit
-    # The return code of the script to Jenkins is only based on the number
-    # of tests thad did run.
-    $callparser -t stats | grep 'failed: 0, not run: 0' > /dev/null
+    # All the outputs are generated by a single parser run. The return code of
+    # the script to Jenkins is only based on the number of tests thad did run.
+    $__LOG_PARSER -f $__LOG_PARSER_MSGS_FILE -n $JOB_NAME \
+        -t human \
+        -t xunit:$BUILD_NUMBER.results.xunit \
+        -t "meas:$measfile" \
+        --check-all-passed
 }
 
 # Header runtime
@@ -741,9 +741,9 @@ function __on_exit() {
         __after_test_run "$1"
     fi
     __step_timeout_parse_wrap __run_ifdef dut_power_off
-    local callparser="$__LOG_PARSER -f $__LOG_PARSER_MSGS_FILE -n $JOB_NAME"
-    __process_measurements "$callparser"
-    __process_test_results "$callparser"
+    local measfile=$BUILD_NUMBER.measurements.hottest.txt
+    __process_test_results "$measfile"
+    __process_measurements "$measfile"
     __before_exit "$1"
     exit $?
 }
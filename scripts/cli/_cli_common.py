@@ -1,7 +1,7 @@
+import hashlib
 import json
-import jsonschema
 import re
-from os import path
+from os import path, listdir, stat
 
 def _remove_dict_comments (d, comment_key='#|comment'):
     r = {}
@@ -50,15 +50,44 @@ def _substitute_refs (root, d, travelled={}, refdict_key='refs'):
         r.update (ret)
     return True, r
 
-def parse_json(filename, schema_filename=None):
-    def _parse_json(filename):
-        try:
-            with open (filename) as f:
-                return json.load(f)
+# Compiled schema validators, keyed by schema path.
+_schema_validators = {}
+# Hashes of (schema, file contents) pairs that passed validation. "None" when
+# validation caching is disabled.
+_validated_hashes = None
+
+def enable_validation_cache(enable=True):
+    '''When enabled "parse_json" skips the schema validation of files whose
+    contents were already validated against the same schema on this process.'''
+    global _validated_hashes
+    _validated_hashes = set() if enable else None
+
+def _load_json(filename, data):
+    try:
+        return json.loads(data)
 
-        except ValueError as ex:
-            raise ValueError('On file: "{}"\n'.format(filename) + str(ex))
-    f = _parse_json (filename)
+    except ValueError as ex:
+        raise ValueError('On file: "{}"\n'.format(filename) + str(ex))
+
+def get_schema_validator(schema_filename):
+    '''Returns the compiled validator of a schema file. Each schema is loaded
+    and compiled only once per process.'''
+    schema_filename = path.realpath (schema_filename)
+    validator = _schema_validators.get (schema_filename)
+    if validator is None:
+        import jsonschema # Slow to import, not needed e.g. by gen.py clients
+        with open (schema_filename, 'rb') as f:
+            s = _load_json (schema_filename, f.read())
+        resolver = jsonschema.RefResolver(
+            'file://{}/'.format (path.dirname(schema_filename)), s)
+        validator = jsonschema.Draft4Validator (s, resolver=resolver)
+        _schema_validators[schema_filename] = validator
+    return validator
+
+def parse_json(filename, schema_filename=None):
+    with open (filename, 'rb') as f:
+        data = f.read()
+    f = _load_json (filename, data)
 
     if type(f) is dict:
         f = _remove_dict_comments (f)
@@ -67,15 +96,22 @@ def parse_json(filename, schema_filename=None):
             raise ValueError ('On file: "{}": {}'.format (filename, f))
 
     if schema_filename is not None:
-        s = _parse_json (schema_filename)
+        validator = get_schema_validator (schema_filename)
+        digest = None
+        if _validated_hashes is not None:
+            digest = (
+                path.realpath (schema_filename), hashlib.sha1 (data).hexdigest())
+            if digest in _validated_hashes:
+                return f
+        import jsonschema
         try:
-            resolver = jsonschema.RefResolver(
-                'file://{}/'.format (path.dirname(schema_filename)), s)
-            jsonschema.Draft4Validator (s, resolver=resolver).validate (f)
+            validator.validate (f)
         except jsonschema.exceptions.ValidationError as ex:
             raise ValueError(
                 'On file: "{}" using schema "{}"\n'.format(
                     filename, schema_filename) + str(ex))
+        if digest is not None:
+            _validated_hashes.add (digest)
     return f
 
 def try_find_chunk_fullpath(includedirs, chunk_path):
@@ -87,6 +123,137 @@ def try_find_chunk_fullpath(includedirs, chunk_path):
             return prefix
     return None
 
+def _get_mtime(dirname):
+    try:
+        return stat (dirname).st_mtime
+    except OSError:
+        return None
+
+def _is_hidden(rel):
+    return any (p.startswith ('.') for p in rel.split (path.sep) if p != '.')
+
+class DirIndex(object):
+    '''Relative paths of the files under a directory, scanned once. The mtime
+    of every directory is kept, so "refresh" detects added, removed or renamed
+    files by only doing a stat per directory.
+
+    Symlinked directories are followed, except when they point to one of
+    their parents (cycles). Hidden directories (e.g. ".git") and broken
+    symlinks aren't indexed.'''
+    def __init__(self, root):
+        self.root = root
+        self._scan()
+
+    def _scan(self):
+        self.files = set()
+        self.dir_mtimes = { self.root : _get_mtime (self.root) }
+        self._scan_dir (self.root, '', frozenset())
+
+    def _scan_dir(self, dirname, rel, parents):
+        try:
+            st = stat (dirname)
+            names = listdir (dirname)
+        except OSError:
+            return
+        key = (st.st_dev, st.st_ino)
+        if key in parents:
+            return # Symlink cycle
+        parents = parents | set ([key])
+        self.dir_mtimes[dirname] = st.st_mtime
+        for name in names:
+            fullpath = path.join (dirname, name)
+            if path.isdir (fullpath):
+                if not name.startswith ('.'):
+                    self._scan_dir(
+                        fullpath, path.join (rel, name), parents)
+            elif path.exists (fullpath): # Not a broken symlink
+                self.files.add (path.join (rel, name))
+
+    def is_stale(self):
+        for dirname, mtime in self.dir_mtimes.items():
+            if _get_mtime (dirname) != mtime:
+                return True
+        return False
+
+    def refresh(self):
+        '''Rescans the directory if it changed. Returns if it did.'''
+        if not self.is_stale():
+            return False
+        self._scan()
+        return True
+
+# "DirIndex" of every include directory used on this process, shared by all
+# the "IncludeIndex"es.
+_dir_indexes = {}
+
+def get_dir_index(dirname):
+    index = _dir_indexes.get (dirname)
+    if index is None:
+        index = DirIndex (dirname)
+        _dir_indexes[dirname] = index
+    return index
+
+def refresh_include_indexes():
+    '''Rescans the include directories that changed since they were indexed,
+    for long running processes.'''
+    for index in _dir_indexes.values():
+        index.refresh()
+
+class IncludeIndex(object):
+    '''Resolves files (chunks, parametrization files, pipelines...) relative
+    to a list of include directories, the first directory having the file
+    takes precedence. Lookups use the "DirIndex" of each directory and return
+    the same paths that probing the filesystem would.'''
+    def __init__(self, includedirs):
+        self.includedirs = list (includedirs)
+        self.dirs = [get_dir_index (d) for d in self.includedirs]
+
+    @staticmethod
+    def _is_relative(rel):
+        '''If "rel" can be looked up on the indexes.'''
+        return (not path.isabs (rel) and rel.split (path.sep, 1)[0] != '..'
+            and not _is_hidden (rel))
+
+    def find(self, suffix):
+        '''Returns the path of the file "suffix" or None.'''
+        rel = path.normpath (suffix)
+        if not self._is_relative (rel):
+            for d in self.includedirs:
+                if path.exists (path.join (d, suffix)):
+                    return path.join (d, suffix)
+            return None
+        for index in self.dirs:
+            if rel in index.files:
+                return path.join (index.root, suffix)
+        return None
+
+    def find_chunk(self, chunk_path):
+        '''Returns the path (without extension) of the chunk "chunk_path"
+        or None. Equivalent to "try_find_chunk_fullpath".'''
+        rel = path.normpath (chunk_path)
+        if not self._is_relative (rel):
+            return try_find_chunk_fullpath (self.includedirs, chunk_path)
+        for index in self.dirs:
+            if rel + '.json' in index.files and rel + '.sh' in index.files:
+                return path.join (index.root, chunk_path)
+        return None
+
+_include_indexes = {}
+
+def clear_include_indexes():
+    '''Drops all the indexes, e.g. when relative include directories refer to
+    a different working directory.'''
+    _dir_indexes.clear()
+    _include_indexes.clear()
+
+def get_include_index(includedirs):
+    '''Returns the "IncludeIndex" of includedirs, built once per process.'''
+    key = tuple (includedirs)
+    index = _include_indexes.get (key)
+    if index is None:
+        index = IncludeIndex (includedirs)
+        _include_indexes[key] = index
+    return index
 
 def jenkins_path_join (path, addpath = ''):
     r = re.sub (r'/+','/', path + '/' + addpath)
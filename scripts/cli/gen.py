@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 
 from xml.etree import ElementTree as ET
-from xml.dom.minidom import parseString as dom_parse_str
 from argparse  import ArgumentParser
-from os import path
+from os import path, stat
+from StringIO import StringIO
+import json
+import os
+import socket
 import sys
 import re
+import signal
+import traceback
 
 from _cli_common import *
 
+# Resolved on import, as "serve" changes the working directory.
+_THISFILE_DIRNAME = path.dirname (path.realpath (__file__))
+
 def thisfile_dirname_join(name):
-    return path.join (path.dirname (path.realpath (__file__)), name)
+    return path.join (_THISFILE_DIRNAME, name)
 
 class GenParseException(Exception):
     def __init__(self, file, line, msg=''):
@@ -28,6 +36,49 @@ class GenException(Exception):
 
 JENKINS_NODE_CMD = 'hottest/noderun.sh' # This is our launch script
 
+def _xml_escape(data):
+    return data.replace ('&', '&amp;').replace ('<', '&lt;').replace(
+        '"', '&quot;').replace ('>', '&gt;')
+
+def _xml_text(data):
+    # XML parsers normalize line endings. Kept for compatibility with the
+    # previous output, that was serialized, re-parsed and pretty printed.
+    return _xml_escape (data.replace ('\r\n', '\n').replace ('\r', '\n'))
+
+def xml_to_str(root, indent='\t'):
+    '''Serializes an ElementTree element indented by "indent" in a single
+    pass. The output is the same that "minidom.toprettyxml()" gave when
+    parsing the "ET.tostring()" output of the element.'''
+    out = ['<?xml version="1.0" ?>\n']
+
+    def write(el, pad):
+        out.append (pad + '<' + el.tag)
+        for name, value in sorted (el.attrib.items()):
+            out.append (' ' + name + '="' + _xml_escape (value) + '"')
+
+        if len (el) == 0:
+            if el.text:
+                out.append ('>' + _xml_text (el.text) + '</' + el.tag + '>\n')
+            else:
+                out.append ('/>\n')
+            return
+
+        out.append ('>\n')
+        if el.text:
+            out.append (pad + indent + _xml_text (el.text) + '\n')
+        for child in el:
+            write (child, pad + indent)
+            if child.tail:
+                out.append (pad + indent + _xml_text (child.tail) + '\n')
+        out.append (pad + '</' + el.tag + '>\n')
+
+    write (root, '')
+    return ''.join (out)
+
+# Chunks wrapping the board and test chunks of every job
+RUNTIME_HEADER_CHUNK = 'runtime/header'
+RUNTIME_FOOTER_CHUNK = 'runtime/footer'
+
 class ParsedBoard(object):
     '''Intermediate representation of a Jenkins node (board)'''
     def __init__(self, name):
@@ -127,16 +178,14 @@ class JenkinsNodeXml(object):
             self._append_envvar(name, val)
 
     def __str__(self):
-        return dom_parse_str(
-            ET.tostring (self.root, encoding='utf8', method='xml')
-                ).toprettyxml()
+        return xml_to_str (self.root)
 
 class BoardData(ParsedBoard):
     '''Board data generator, just adds methods to ParsedBoard.'''
     def __init__(self, name, includedirs, board_chunk, param_files):
         super (BoardData, self).__init__(name)
 
-        cpath = try_find_chunk_fullpath (includedirs, board_chunk)
+        cpath = get_include_index (includedirs).find_chunk (board_chunk)
         if cpath is None:
             raise GenException(
                 'Could not find chunk files for board root. (json, sh or both): {}'
@@ -144,8 +193,7 @@ class BoardData(ParsedBoard):
 
         self.labels[path.splitext (path.basename(board_chunk))[0]] = True
 
-        pboard = parse_json(
-            cpath + '.json', thisfile_dirname_join ('_schema_chunk_board.json'))
+        pboard = chunk_cache.get (cpath).get_json ('_schema_chunk_board.json')
 
         self.fs_path = pboard.get('fs-path') # Not exposed on JSON schema
         self.description = from_strlist (pboard.get('description'))
@@ -186,9 +234,14 @@ class ParsedTest(object):
         self.required_board_envvars = {}
         self.parameters = {}
         self.labels = {}
-        self.script = "#!/bin/bash\n"
+        # Script segments, only joined when the script is read.
+        self.script_segments = ["#!/bin/bash\n"]
         self.parameter_overrides = {}
 
+    @property
+    def script(self):
+        return ''.join (self.script_segments)
+
     def __str__(self):
         s  =     '[name       ] {}\n'.format (self.name)
         s +=     '[description] {}\n'.format (self.description)
@@ -318,34 +371,183 @@ class JenkinsJobXml(object):
             self._add_param (param, desc, default)
 
     def __str__(self):
-        return dom_parse_str(
-            ET.tostring (self.root, encoding='utf8', method='xml')
-                ).toprettyxml()
+        return xml_to_str (self.root)
+
+# Token types of the preprocessed ".sh" part of a chunk
+CHUNK_TEXT                       = 0
+CHUNK_BOARD_REQUIRE_ENV          = 1
+CHUNK_INCLUDE                    = 2
+CHUNK_PARAMETER_DEFAULT_OVERRIDE = 3
+
+# Chunk directives: name -> (pattern, token type, name on errors)
+_CHUNK_DIRECTIVE_RE = re.compile(
+    r'#\|(board-require-env|include|parameter-default-override)')
+_CHUNK_DIRECTIVES = {
+    'board-require-env' : (
+        re.compile (r'^#\|board-require-env +<([A-Za-z_][A-Za-z0-9_]*)>$'),
+        CHUNK_BOARD_REQUIRE_ENV,
+        'require-board'),
+    'include' : (
+        re.compile (r'^#\|include +<([A-Za-z0-9/_\-\.]*)>$'),
+        CHUNK_INCLUDE,
+        'include'),
+    'parameter-default-override' : (
+        re.compile(
+            r'^#\|parameter-default-override +<([A-Za-z_][A-Za-z0-9_]*) +(.*)>$'),
+        CHUNK_PARAMETER_DEFAULT_OVERRIDE,
+        'parameter-default-override'),
+}
+
+def _unquote(value):
+    if (value.startswith('"') and value.endswith('"') or
+            value.startswith("'") and value.endswith("'")):
+
+        value = value[1:-1]
+    return value
+
+def lex_chunk(fname):
+    '''Splits the ".sh" file of a chunk on a list of (line, token type, value)
+    tuples. Consecutive text lines are merged on a single CHUNK_TEXT token.'''
+    tokens = []
+    text = []
+
+    def flush_text(idx):
+        if text:
+            tokens.append ((idx - len (text), CHUNK_TEXT, ''.join (text)))
+            del text[:]
+
+    idx = 0
+    with open(fname) as f:
+        for idx, line in enumerate (f, 1):
+            match = None
+            if '#|' in line:
+                sline = line.strip()
+                match = _CHUNK_DIRECTIVE_RE.match (sline)
+
+            if match is None:
+                if not line.endswith('\n'): # Append trailing file '\n'
+                    line += '\n'
+                text.append (line)
+                continue
+
+            pattern, token, errname = _CHUNK_DIRECTIVES[match.group (1)]
+            match = pattern.match (sline)
+            if match is None:
+                raise GenParseException(
+                    fname,
+                    idx,
+                    'Invalid #|{} directive: {}'.format (errname, sline))
+
+            if token == CHUNK_PARAMETER_DEFAULT_OVERRIDE:
+                value = (match.group (1), _unquote (match.group (2)))
+            else:
+                value = match.group (1)
+
+            flush_text (idx)
+            tokens.append ((idx, token, value))
+
+    flush_text (idx + 1)
+    return tokens
+
+class ParsedChunk(object):
+    '''Preprocessed chunk (".json" + ".sh" file pair). The ".sh" file is
+    stored as a directive stream of (line, token type, value) tuples, where
+    consecutive text lines are merged on a single CHUNK_TEXT token, so they
+    are shared as one immutable block by every job including the chunk. The
+    ".json" file is stored once per schema it was validated against.'''
+    def __init__(self, chunk_path, signature):
+        self.path      = chunk_path
+        self.signature = signature
+        self.tokens    = []
+        self.includes  = [] # Include graph: chunks referenced by this chunk
+        self._json     = {}
+        self._preprocess()
+
+    def get_json(self, schema_name):
+        fdata = self._json.get (schema_name)
+        if fdata is None:
+            fdata = parse_json(
+                self.path + '.json', thisfile_dirname_join (schema_name))
+            self._json[schema_name] = fdata
+        return fdata
+
+    def _preprocess(self):
+        self.tokens = lex_chunk (self.path + '.sh')
+        self.includes = [
+            value for _, token, value in self.tokens if token == CHUNK_INCLUDE]
+
+class ChunkCache(object):
+    '''Process-wide cache of "ParsedChunk"s, so every chunk is read and
+    validated only once when generating many jobs (e.g. from sync.py). Entries
+    are keyed by resolved path and invalidated when the mtime or size of any of
+    the chunk files changes.'''
+    def __init__(self):
+        self.chunks = {}
+
+    def get(self, chunk_path):
+        key = path.realpath (chunk_path)
+        signature = []
+        for ext in ('.json', '.sh'):
+            st = stat (key + ext)
+            signature += [st.st_mtime, st.st_size]
+
+        chunk = self.chunks.get (key)
+        if chunk is None or chunk.signature != signature:
+            chunk = ParsedChunk (key, signature)
+            self.chunks[key] = chunk
+        return chunk
+
+    def clear(self):
+        self.chunks = {}
+
+chunk_cache = ChunkCache()
+
+def get_chunk_files(includedirs, root_chunks):
+    '''Returns the paths of the files of root_chunks and of every chunk they
+    include (recursively). Chunks that can't be found are skipped, generating
+    from them will report the error.'''
+    files = []
+    visited = {}
+    index = get_include_index (includedirs)
+
+    def visit(chunk_path):
+        if chunk_path is None or chunk_path in visited:
+            return
+        visited[chunk_path] = True
+        files.extend ([chunk_path + '.json', chunk_path + '.sh'])
+        for ichunk in chunk_cache.get (chunk_path).includes:
+            visit (index.find_chunk (ichunk))
+
+    for chunk in root_chunks:
+        visit (index.find_chunk (chunk))
+    return files
 
 class TestScript(object):
     '''Iterates test chunks, stores the script and accumulates labels and
     parameters'''
     def __init__(self, parsedtest, includedirs):
         self.parsedtest = parsedtest
-        self.includedirs = includedirs
+        self.index = get_include_index (includedirs)
         self.included = {}
 
     def add_chunk(self, chunk_path, schema_name, lvl = 0):
-        '''Adds a chunk and updates the results on parsedtest'''
+        '''Adds a chunk and updates the results on parsedtest. Returns the
+        "ParsedChunk" of chunk_path.'''
         lvl += 1
         if lvl == 1:
             # Only root chunks are passed to this function without full paths,
             # as they are unknown, so we try a match on the include directories.
             old_path   = chunk_path
-            chunk_path = try_find_chunk_fullpath (self.includedirs, chunk_path)
+            chunk_path = self.index.find_chunk (chunk_path)
             if chunk_path is None:
                 raise GenException(
                     'Could not find chunk files for root. (json, sh or both): {}'
                         .format(old_path))
+        chunk = chunk_cache.get (chunk_path)
+
         # Parsing the standard "json" part of a regular chunk: the "test-labels" and
         # "parameters" properties.
-        fdata = parse_json(
-            chunk_path + '.json', thisfile_dirname_join (schema_name))
+        fdata = chunk.get_json (schema_name)
 
         for label in fdata.get('test-labels') or []:
             self.parsedtest.labels[label] = True
@@ -360,84 +562,42 @@ class TestScript(object):
                 'default'     : from_strlist (param.get('default') or '')
             }
 
-        # Preprocessing the ".sh" part of the chunk. This can lead to recursion
-        # through the "#|include <file>" directive.
+        # Expanding the preprocessed ".sh" part of the chunk. This can lead to
+        # recursion through the "#|include <file>" directive.
         fname  = chunk_path + '.sh'
         lvlstr = '#' * lvl
-        self.parsedtest.script += '\n{} File contents of: {} {}\n'.format(
-            lvlstr, fname, lvlstr)
-        with open(fname) as f:
-            for idx, line in enumerate (f.readlines(), 1):
-                sline = line.strip()
-                included_chunk_path = None
-
-                if sline.startswith('#|board-require-env'):
-                    match = re.match(
-                        r'^#\|board-require-env +<([A-Za-z_][A-Za-z0-9_]*)>$',
-                        sline)
-                    try:
-                        envvar = match.group(1)
-                    except:
-                        raise GenParseException(
-                            fname, idx, 'Invalid #|require-board directive: {}'
-                                .format (sline))
-
-                    self.parsedtest.required_board_envvars[envvar] = True
-                    continue
-
-                if sline.startswith('#|include'):
-                    match = re.match(
-                        r'^#\|include +<([A-Za-z0-9/_\-\.]*)>$', sline)
-                    try:
-                        ichunk = match.group(1)
-                    except:
-                        raise GenParseException(
-                            fname,
-                            idx,
-                            'Invalid #|include directive: {}'.format (sline))
-
-                    ichunk_path = try_find_chunk_fullpath(
-                        self.includedirs, ichunk)
-
-                    if ichunk_path is None:
-                        raise GenParseException(
-                            fname,
-                            idx,
-                            'Could not find chunk files for #include directive. (json, sh or both)')
-
-                    if ichunk_path not in self.included:
-                        self.add_chunk(
-                            ichunk_path, '_schema_chunk_test.json', lvl)
-                        self.included[ichunk_path] = True
-                    else:
-                        self.parsedtest.script += '{}gen.py: #|include <{}> was guarded\n'.format(
-                            lvlstr, ichunk)
-                    continue
-
-                if sline.startswith('#|parameter-default-override'):
-                    match = re.match(
-                        r'^#\|parameter-default-override +<([A-Za-z_][A-Za-z0-9_]*) +(.*)>$',
-                        sline)
-                    try:
-                        var   = match.group (1)
-                        value = match.group (2)
-                    except:
-                        raise GenParseException(
-                            fname,
-                            idx,
-                            'Invalid #|parameter-default-override directive: {}'
-                                .format (sline))
-                    if (value.startswith('"') and value.endswith('"') or
-                            value.startswith("'") and value.endswith("'")):
-
-                        value = value[1:-1]
-
-                    self.parsedtest.parameter_overrides[var] = value
-                    continue
+        segments = self.parsedtest.script_segments
+        segments.append ('\n{} File contents of: {} {}\n'.format(
+            lvlstr, fname, lvlstr))
+        for idx, token, value in chunk.tokens:
+            if token == CHUNK_TEXT:
+                segments.append (value)
+
+            elif token == CHUNK_BOARD_REQUIRE_ENV:
+                self.parsedtest.required_board_envvars[value] = True
+
+            elif token == CHUNK_INCLUDE:
+                ichunk_path = self.index.find_chunk (value)
+
+                if ichunk_path is None:
+                    raise GenParseException(
+                        fname,
+                        idx,
+                        'Could not find chunk files for #include directive. (json, sh or both)')
+
+                if ichunk_path not in self.included:
+                    self.add_chunk(
+                        ichunk_path, '_schema_chunk_test.json', lvl)
+                    self.included[ichunk_path] = True
+                else:
+                    segments.append ('{}gen.py: #|include <{}> was guarded\n'.format(
+                        lvlstr, value))
 
-                if not line.endswith('\n'): # Append trailing file '\n'
-                    line += '\n'
-                self.parsedtest.script += line
+            elif token == CHUNK_PARAMETER_DEFAULT_OVERRIDE:
+                var, val = value
+                self.parsedtest.parameter_overrides[var] = val
+
+        return chunk
 
 class TestData(ParsedTest):
     '''Test data generator, just adds methods to ParserTest.'''
@@ -454,10 +614,10 @@ class TestData(ParsedTest):
 
         # Fill ParsedTest (self) using the TestScript generator.
         ts = TestScript (self, includedirs)
-        ts.add_chunk ('runtime/header', '_schema_chunk_test.json')
-        ts.add_chunk (board_chunk, '_schema_chunk_board.json')
-        ts.add_chunk (test_chunk, '_schema_chunk_test.json')
-        ts.add_chunk ('runtime/footer', '_schema_chunk_test.json')
+        ts.add_chunk (RUNTIME_HEADER_CHUNK, '_schema_chunk_test.json')
+        bchunk = ts.add_chunk (board_chunk, '_schema_chunk_board.json')
+        tchunk = ts.add_chunk (test_chunk, '_schema_chunk_test.json')
+        ts.add_chunk (RUNTIME_FOOTER_CHUNK, '_schema_chunk_test.json')
 
         # Process the parameter-default-override directive
         for p, v in self.parameter_overrides.items():
@@ -468,11 +628,7 @@ class TestData(ParsedTest):
             self.parameters[p]['default'] = v
 
         # Append job specific properties (decription as of now).
-        # "test_chunk_path" won't be None if TestScript didn't bail out
-        test_chunk_path = try_find_chunk_fullpath (includedirs, test_chunk)
-        jsprops = parse_json(
-            test_chunk_path + '.json',
-            thisfile_dirname_join ('_schema_chunk_test.json'))
+        jsprops = tchunk.get_json ('_schema_chunk_test.json')
         desc = from_strlist (jsprops.get ('description') or '')
 
         # Add labels
@@ -480,9 +636,10 @@ class TestData(ParsedTest):
             self.labels[label] = True
 
         # Verify environment variables
-        bd = BoardData ('dummyname', includedirs, board_chunk, [])
+        bdata = bchunk.get_json ('_schema_chunk_board.json')
+        board_envvars = bdata.get ('environment-variables') or {}
         for ev in self.required_board_envvars:
-            if not ev in bd.envvars:
+            if not ev in board_envvars:
                 raise GenException(
                     'Board "{}" is missing a required environment variable: {}'
                         .format(board_chunk, ev))
@@ -519,7 +676,11 @@ class ParsedPipeline(object):
         self.tests = {}
         self.serial_seqs = {}
         self.execution = []
-        self.script = ''
+        self.script_segments = []
+
+    @property
+    def script(self):
+        return ''.join (self.script_segments)
 
     def _add_test_if_new(self, name):
         if name not in self.tests:
@@ -566,7 +727,7 @@ class JenkinsPipelineXml(object):
         if timerexpr is not None and timerexpr != '':
             ptjp = ET.SubElement(
                 properties,
-                'org.jenkinsci.plugins.workflow.job.properties.PipelineTriggersJobProperty>')
+                'org.jenkinsci.plugins.workflow.job.properties.PipelineTriggersJobProperty')
             triggers = ET.SubElement(ptjp, 'triggers')
             timer_trigger = ET.SubElement(triggers, 'hudson.triggers.TimerTrigger')
             spec = ET.SubElement(timer_trigger, 'spec')
@@ -590,9 +751,7 @@ class JenkinsPipelineXml(object):
         self.root = root
 
     def __str__(self):
-        return dom_parse_str(
-            ET.tostring (self.root, encoding='utf8', method='xml')
-                ).toprettyxml()
+        return xml_to_str (self.root)
 
 class PipelineData(ParsedPipeline):
     '''Pipeline data generator, just adds methods to ParsedPipeline.'''
@@ -652,7 +811,7 @@ class PipelineData(ParsedPipeline):
         # See https://issues.jenkins-ci.org/browse/JENKINS-26522
 
         def nl(txt, join='\n'):
-            self.script += txt + join
+            self.script_segments.append (txt + join)
 
         nl('jobs    = [:]')
         nl('failed  = [:]')
@@ -870,8 +1029,120 @@ def add_folder_parser(subparsers, cmdname, fn):
     p = subparsers.add_parser(cmdname, help=cmdname + ' help')
     p.set_defaults(func=fn)
 
-def main():
+# When set, the generator commands are forwarded to the server listening on
+# this Unix socket (see "serve").
+GEN_SOCKET_ENV = 'HOTTEST_GEN_SOCKET'
+
+def _recv_all(conn):
+    data = []
+    while True:
+        block = conn.recv (65536)
+        if not block:
+            return b''.join (data)
+        data.append (block)
+
+def forward_to_server(socket_path, argv):
+    '''Runs a generator command on the server. Returns its exit status or
+    None if the server isn't running.'''
+    conn = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect (socket_path)
+    except socket.error:
+        conn.close()
+        return None
+    try:
+        conn.sendall (json.dumps ({ 'argv' : argv, 'cwd' : os.getcwd() }))
+        conn.shutdown (socket.SHUT_WR)
+        reply = json.loads (_recv_all (conn))
+    finally:
+        conn.close()
+    sys.stdout.write (reply['stdout'].encode ('utf-8'))
+    sys.stderr.write (reply['stderr'].encode ('utf-8'))
+    return reply['status']
+
+def _to_text(data):
+    return data if isinstance (data, unicode) else data.decode ('utf-8')
+
+def _serve_request(request):
+    '''Runs a generator command capturing its output, returns the reply.'''
+    out, err = StringIO(), StringIO()
+    sys.stdout, sys.stderr = out, err
+    status = 0
+    try:
+        os.chdir (request['cwd'])
+        run (request['argv'])
+    except SystemExit as e:
+        status = e.code if isinstance (e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    return {
+        'status' : status,
+        'stdout' : _to_text (out.getvalue()),
+        'stderr' : _to_text (err.getvalue()),
+    }
+
+def serve(args):
+    '''Generator server. Runs the commands forwarded by clients (see
+    "forward_to_server") one at a time, keeping the chunk cache, include
+    indexes and compiled schemas warm between them. Edited chunks are
+    detected by their mtime and added or removed files by rescanning the
+    include directories that changed.'''
+    if not args.socket:
+        raise GenException(
+            'No socket path. Pass "--socket" or set {}'.format (GEN_SOCKET_ENV))
+    if path.exists (args.socket):
+        os.remove (args.socket) # Stale socket of a previous server
+
+    enable_validation_cache()
+    sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask (0o077) # Only the owner can connect
+    try:
+        sock.bind (args.socket)
+    finally:
+        os.umask (umask)
+    sock.listen (16)
+    # Exit through "finally" to remove the socket file.
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (0))
+    print ('gen.py: serving on: {}'.format (args.socket))
+
+    cwd = None
+    try:
+        while True:
+            conn, _ = sock.accept()
+            try:
+                request = json.loads (_recv_all (conn))
+                if request['cwd'] != cwd:
+                    # Include dirs are relative to the client directory
+                    clear_include_indexes()
+                    cwd = request['cwd']
+                else:
+                    refresh_include_indexes()
+                conn.sendall (json.dumps (_serve_request (request)))
+            except Exception:
+                traceback.print_exc()
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        os.remove (args.socket)
+
+def add_serve_parser(subparsers, cmdname, fn):
+    p = subparsers.add_parser(cmdname, help=cmdname + ' help')
+    p.add_argument(
+        '-s', '--socket',
+        action='store',
+        required=False,
+        default=os.environ.get (GEN_SOCKET_ENV),
+        help='Unix socket path to listen on. Defaults to the {} environment variable.'
+            .format (GEN_SOCKET_ENV))
+    p.set_defaults(func=fn)
+
+def run(argv):
     p = ArgumentParser(
+        prog='gen.py',
         description='"Hottest" tool to generate Jenkins files')
     subp = p.add_subparsers(help='command help')
 
@@ -898,8 +1169,18 @@ def main():
 
     add_folder_parser (subp, "get-folder-xml", get_folder)
 
-    args = p.parse_args()
+    add_serve_parser (subp, "serve", serve)
+
+    args = p.parse_args(argv)
     args.func (args)
 
+def main():
+    socket_path = os.environ.get (GEN_SOCKET_ENV)
+    if socket_path and sys.argv[1:2] != ['serve']:
+        status = forward_to_server (socket_path, sys.argv[1:])
+        if status is not None:
+            sys.exit (status)
+    run (sys.argv[1:])
+
 if __name__ == '__main__':
     main()
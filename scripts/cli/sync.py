@@ -2,10 +2,17 @@
 
 import jenkins
 import fnmatch
+import hashlib
+import json
 import re
-from os import path, makedirs, walk
+import tarfile
+import threading
+import time
+from io import BytesIO
+from os import path, makedirs, walk, rename, link, listdir, remove
 from datetime import datetime
 from argparse import ArgumentParser
+from xml.etree import ElementTree as ET
 
 from _cli_common import *
 import gen
@@ -38,6 +45,7 @@ class DryRunJenkins(jenkins.Jenkins):
     def __init__(self, *args, **kwargs):
         super (DryRunJenkins, self).__init__(*args, **kwargs)
         self.dump_type = ''
+        self.dump_lock = threading.Lock()
 
     def create_node (self, *args, **kwargs):
         pass
@@ -52,12 +60,25 @@ class DryRunJenkins(jenkins.Jenkins):
         self._dump_data (name, data)
 
     def _dump_data(self, name, data):
-        if self.dump_type == 'xml':
-            print ('---XML dump for: "{}"'.format(name) + ("-") * 20)
-            print(data.get_jenkins_xml())
-        elif self.dump_type == 'metadata':
-            print ('---Metadata for: "{}"'.format(name) + ("-") * 20)
-            print (str (data))
+        with self.dump_lock: # Uploads may run concurrently
+            if self.dump_type == 'xml':
+                print ('---XML dump for: "{}"'.format(name) + ("-") * 20)
+                print(data.get_jenkins_xml())
+            elif self.dump_type == 'metadata':
+                print ('---Metadata for: "{}"'.format(name) + ("-") * 20)
+                print (str (data))
+
+def srv_set_max_connections(srv, count):
+    '''Sizes the keep-alive connection pool of the server's HTTP session, so
+    concurrent requests reuse connections instead of opening new ones.'''
+    session = getattr (srv, '_session', None)
+    if session is None:
+        return # python-jenkins without a requests session
+
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter (pool_connections=1, pool_maxsize=count)
+    session.mount ('http://', adapter)
+    session.mount ('https://', adapter)
 
 def thisfile_dirname_join(name):
     return path.join (path.dirname (path.realpath (__file__)), name)
@@ -69,6 +90,219 @@ class SyncException(Exception):
     def __str__(self):
         return repr(self.msg)
 
+def xml_hash(xml):
+    '''Hash of the canonical form of an XML document. The declaration,
+    attribute order and whitespace-only text between elements (e.g. the
+    indentation added by "toprettyxml" or by Jenkins) don't affect it. The
+    text of elements without children is kept as is, whitespace matters
+    there (e.g. a parameter default of " ").'''
+    xml = re.sub (r'^\s*<\?xml[^>]*\?>', '', xml) # expat rejects XML 1.1
+    if not isinstance (xml, bytes):
+        xml = xml.encode ('utf-8')
+
+    def between(text):
+        return text if text and text.strip() else ''
+
+    def canonical(el):
+        children = list (el)
+        if not children:
+            return (el.tag, sorted (el.attrib.items()), el.text or '', [])
+        return (
+            el.tag,
+            sorted (el.attrib.items()),
+            between (el.text),
+            [(canonical (child), between (child.tail)) for child in children])
+
+    canon = repr (canonical (ET.fromstring (xml)))
+    return hashlib.sha1 (canon.encode ('utf-8')).hexdigest()
+
+class SyncUploader(object):
+    '''Runs the server modifications of a sync on a bounded pool of threads
+    and aggregates their results, so a failing item doesn't abort the sync.
+
+    With "skip_unchanged" existing items are only reconfigured when their
+    configuration on the server differs from the generated one.
+
+    With a "state" (SyncState) every successfully uploaded item carrying
+    inputs is recorded on it.'''
+    def __init__(self, max_requests=1, skip_unchanged=False, state=None):
+        self.max_requests = max_requests
+        self.skip_unchanged = skip_unchanged
+        self.state = state
+        self.counts = {}
+        self.failures = []
+
+    def count(self, itemtype, action):
+        key = (itemtype, action)
+        self.counts[key] = self.counts.get (key, 0) + 1
+
+    def _record(self, item):
+        if self.state is not None and item.inputs is not None:
+            self.state.update(
+                item.state_key,
+                item.inputs,
+                xml_hash (item.data.get_jenkins_xml()))
+
+    def create_fn(self, create, item):
+        '''Returns a task function that creates "item" (JenkinsSync) using
+        create(name, data).'''
+        def create_item():
+            create (item.name, item.data)
+            self._record (item)
+        return create_item
+
+    def update_fn(self, get_config, reconfig, item):
+        '''Returns a task function that reconfigures the already existing
+        "item" (JenkinsSync) using reconfig(name, data).'''
+        def update():
+            name = item.name
+            data = item.data
+            action = None
+            if not self.skip_unchanged:
+                reconfig (name, data)
+            else:
+                xml = data.get_jenkins_xml()
+                try:
+                    unchanged = xml_hash (get_config (name)) == xml_hash (xml)
+                except Exception:
+                    # e.g. unparseable server config, just push ours.
+                    unchanged = False
+                if unchanged:
+                    action = 'unchanged'
+                else:
+                    reconfig (name, RenderedData (data, xml))
+            self._record (item)
+            return action
+        return update
+
+    def run(self, itemtype, tasks):
+        '''Runs a list of (name, action, fn) tasks. "fn" takes no arguments and
+        may return a string overriding the action (e.g. "unchanged"). Tasks on
+        the same call run concurrently, so dependencies between items (e.g.
+        folders) have to be resolved before.'''
+        def _run_task(task):
+            try:
+                return task[2](), None
+            except Exception as e:
+                return None, e
+
+        if self.max_requests <= 1 or len (tasks) <= 1:
+            results = [_run_task (task) for task in tasks]
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool (min (self.max_requests, len (tasks)))
+            try:
+                results = pool.map (_run_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        for (name, action, _), (newaction, error) in zip (tasks, results):
+            action = newaction or action
+            if error is not None:
+                self.failures.append ((itemtype, name, error))
+                action = 'failed'
+            self.count (itemtype, action)
+
+    def report(self):
+        '''Prints a summary. Raises if any of the tasks failed.'''
+        print('sync summary:')
+        for (itemtype, action), count in sorted (self.counts.items()):
+            print('  {} {}: {}'.format (itemtype, action, count))
+
+        for itemtype, name, error in self.failures:
+            print('{} "{}": sync failed: {}'.format(
+                itemtype, name, getattr (error, 'msg', error)))
+
+        if len (self.failures) > 0:
+            raise SyncException(
+                '{} item(s) failed to sync'.format (len (self.failures)))
+
+class SyncState(object):
+    '''Local record of what a sync pushed to a Jenkins server: for each item
+    the hashes of the files (and sync file entry) it was generated from and
+    the hash of the pushed XML. Allows skipping the generation and upload of
+    items whose inputs didn't change since the last sync.'''
+    VERSION = 1
+
+    def __init__(self, filename, verify=False):
+        self.filename = filename
+        self.verify = verify
+        self.items = {}
+        self.file_hashes = {}
+        self.lock = threading.Lock()
+        if path.exists (filename):
+            with open (filename) as f:
+                state = json.load (f)
+            if state.get ('version') == self.VERSION:
+                self.items = state['items']
+
+    def get_inputs(self, files, entry):
+        '''Returns the inputs (dict of hashes) of an item generated from
+        "files" and the sync file entry "entry" (json serializable).'''
+        inputs = {
+            '#|sync-entry' : hashlib.sha1(
+                json.dumps (entry, sort_keys=True).encode ('utf-8')).hexdigest()
+        }
+        for file in files:
+            digest = self.file_hashes.get (file)
+            if digest is None:
+                with open (file, 'rb') as f:
+                    digest = hashlib.sha1 (f.read()).hexdigest()
+                self.file_hashes[file] = digest
+            inputs[file] = digest
+        return inputs
+
+    def is_current(self, key, inputs):
+        item = self.items.get (key)
+        return item is not None and item['inputs'] == inputs
+
+    def get_xml_hash(self, key):
+        return self.items[key]['xml']
+
+    def update(self, key, inputs, xmlhash):
+        with self.lock:
+            self.items[key] = { 'inputs' : inputs, 'xml' : xmlhash }
+
+    def save(self):
+        folder = path.dirname (self.filename)
+        if folder and not path.exists (folder):
+            makedirs (folder)
+        tmp = self.filename + '.tmp'
+        with open (tmp, 'w') as f:
+            json.dump(
+                { 'version' : self.VERSION, 'items' : self.items },
+                f,
+                indent=1,
+                sort_keys=True)
+        rename (tmp, self.filename)
+
+SYNC_STATE_FOLDER = 'hottest.state'
+
+def _sync_state_name(text):
+    return re.sub (r'[^A-Za-z0-9_.-]+', '_', text)
+
+def sync_state_filename(jenkins_url, root_folder):
+    '''Each Jenkins instance and root folder have its own sync state file.'''
+    name = _sync_state_name(
+        '{}-{}'.format (jenkins_url, jenkins_path_join (root_folder)))
+    return path.join (SYNC_STATE_FOLDER, name + '.json')
+
+def drop_sync_states(jenkins_url):
+    '''Removes the sync state files of every root folder of "jenkins_url",
+    for when its configs are changed by other means than a sync (e.g. a
+    revert). The next sync regenerates and checks every item. The name
+    prefix can match the states of other URLs too, which only costs them a
+    full sync.'''
+    if not path.isdir (SYNC_STATE_FOLDER):
+        return
+    prefix = _sync_state_name (jenkins_url + '-')
+    for name in sorted (listdir (SYNC_STATE_FOLDER)):
+        if name.startswith (prefix) and name.endswith ('.json'):
+            filename = path.join (SYNC_STATE_FOLDER, name)
+            print ('dropping sync state: "{}"'.format (filename))
+            remove (filename)
+
 def is_in_whitelist(name, whitelist):
     if len (whitelist)==0:
         return True
@@ -84,12 +318,15 @@ def is_in_whitelist(name, whitelist):
 class GenGetJobDataArgs(object):
     '''Collection of arguments for "gen.get_job_data" call'''
     def __init__(self):
+        self.chunk_dirs = []
         self.extra_labels = []
         self.param_files = []
         self.name = None
         self.board_chunk = None
         self.test_chunk = None
         self.inline_parametrization = None
+        self.state_key = None
+        self.inputs = None
 
 class GenGetPipelineDataArgs(object):
     '''Collection of arguments for "gen.get_pipeline_data" call'''
@@ -97,21 +334,22 @@ class GenGetPipelineDataArgs(object):
         self.name        = None
         self.file        = None
         self.root_folder = ''
+        self.state_key   = None
+        self.inputs      = None
 
 class GenGetNodeDataArgs(object):
     '''Collection of arguments for "gen.get_node_data" call'''
     def __init__(self):
+        self.chunk_dirs = []
         self.param_files = []
         self.name = None
         self.board_chunk = None
         self.inline_parametrization = None
+        self.state_key = None
+        self.inputs = None
 
 def try_find_suffix_in_dirs(suffix, param_dirs):
-    for d in param_dirs:
-        f = path.join (d, suffix)
-        if path.exists (f):
-            return f
-    return None
+    return get_include_index (param_dirs).find (suffix)
 
 def build_job_arglists(syncjson, root_folder, chunk_dirs, param_dirs):
     '''Builds an array of GenGetJobDataArgs from the tests of a given sync
@@ -125,6 +363,7 @@ def build_job_arglists(syncjson, root_folder, chunk_dirs, param_dirs):
         name = jenkins_path_join (name) # canonicalization
         args = GenGetJobDataArgs()
         args.name = jenkins_path_join (root_folder, name)
+        args.chunk_dirs = chunk_dirs
         args.board_chunk = data['board-chunk']
         args.test_chunk = data['test-chunk']
         args.extra_labels = data.get ('extra-labels') or []
@@ -174,6 +413,7 @@ def build_node_arglists(syncjson, chunk_dirs, param_dirs):
     for name, data in nodes.items():
         args = GenGetNodeDataArgs()
         args.name = name
+        args.chunk_dirs = chunk_dirs
         args.board_chunk = data['board-chunk']
         for fsuffix in data.get ('parametrization-files') or []:
             pf = try_find_suffix_in_dirs (fsuffix, param_dirs)
@@ -188,16 +428,236 @@ def build_node_arglists(syncjson, chunk_dirs, param_dirs):
     return arglist
 
 class JenkinsSync(object):
-    def __init__(self, name, data):
+    def __init__(self, name, data, state_key=None, inputs=None):
         self.name = name
         self.data = data
+        self.state_key = state_key
+        self.inputs = inputs
+
+class RenderedData(object):
+    '''Generated data with its Jenkins XML already rendered (e.g. on a worker
+    process).'''
+    def __init__(self, data, xml):
+        self.data = data
+        self.xml  = xml
+
+    def get_jenkins_xml(self):
+        return self.xml
+
+    def __str__(self):
+        return str(self.data)
+
+def unwrap_data(data):
+    '''Returns the gen data object of a possibly rendered one.'''
+    return data.data if isinstance (data, RenderedData) else data
+
+def gen_test_data(args):
+    td = gen.TestData(
+        args.chunk_dirs,
+        args.board_chunk,
+        args.test_chunk,
+        args.extra_labels,
+        args.param_files)
+
+    td.add_parametrization(
+        args.inline_parametrization,
+        'sync\'s "parametrization-inline" for "{}"'.format (args.name))
+    return td
+
+def gen_node_data(args):
+    bd = gen.BoardData(
+        args.name, args.chunk_dirs, args.board_chunk, args.param_files)
+    bd.add_parametrization(
+        args.inline_parametrization,
+        'sync\'s "parametrization-inline" for "{}"'.format (args.name))
+    return bd
+
+def gen_pipeline_data(args):
+    return gen.PipelineData (args.file, args.root_folder)
+
+def _gen_data(work):
+    '''Generates (and optionally renders) a single item. Runs on the worker
+    processes of "gen_all_data", so it can't have closures.'''
+    itemtype, gen_fn, args, render = work
+    try:
+        data = gen_fn (args)
+        return data, data.get_jenkins_xml() if render else None
+    except Exception as e:
+        raise SyncException('{} "{}": generation failed: {}'.format(
+            itemtype, args.name, getattr (e, 'msg', e)))
+
+def gen_all_data(itemtype, gen_fn, arglist, jobs, render=False):
+    '''Runs "gen_fn" on each element of arglist. When jobs > 1 the generation
+    and XML rendering are fanned out over a process pool. Returns a list of
+    JenkinsSync with the same order as arglist.'''
+    for args in arglist:
+        print('{} "{}": generating'.format (itemtype, args.name))
+
+    if jobs <= 1 or len (arglist) <= 1:
+        results = [
+            _gen_data ((itemtype, gen_fn, args, render)) for args in arglist]
+    else:
+        from multiprocessing import Pool
+        pool = Pool (min (jobs, len (arglist)))
+        try:
+            results = pool.map(
+                _gen_data, [(itemtype, gen_fn, args, True) for args in arglist])
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return [
+        JenkinsSync(
+            args.name,
+            data if xml is None else RenderedData (data, xml),
+            args.state_key,
+            args.inputs)
+        for args, (data, xml) in zip (arglist, results)]
+
+def _gen_inputs_files():
+    # The generator itself is an input of every item.
+    return [
+        thisfile_dirname_join (f)
+        for f in ('gen.py', '_cli_common.py', 'sync.py')]
+
+def test_inputs_files(args):
+    return _gen_inputs_files() + args.param_files + gen.get_chunk_files(
+        args.chunk_dirs,
+        [gen.RUNTIME_HEADER_CHUNK,
+            args.board_chunk,
+            args.test_chunk,
+            gen.RUNTIME_FOOTER_CHUNK])
+
+def node_inputs_files(args):
+    return _gen_inputs_files() + args.param_files + gen.get_chunk_files(
+        args.chunk_dirs, [args.board_chunk])
+
+def pipeline_inputs_files(args):
+    return _gen_inputs_files() + [args.file]
+
+def filter_unchanged(itemtype, arglist, files_fn, get_config, uploader):
+    '''Drops the elements of arglist whose inputs didn't change since they were
+    last uploaded according to the uploader's sync state. When the state has
+    "verify" set they are only dropped if the XML on the server matches the
+    recorded one. The inputs of the remaining elements are stored on them, so
+    the state can be updated after uploading.'''
+    state = uploader.state
+    if state is None:
+        return arglist
+
+    remaining = []
+    for args in arglist:
+        entry = dict(
+            (k, v) for k, v in vars (args).items()
+            if k not in ('state_key', 'inputs'))
+        args.state_key = '{}:{}'.format (itemtype, args.name)
+        try:
+            args.inputs = state.get_inputs (files_fn (args), entry)
+        except Exception:
+            args.inputs = None # Generation will report the error, if any.
+            remaining.append (args)
+            continue
+
+        current = (uploader.skip_unchanged and
+            state.is_current (args.state_key, args.inputs))
+        if current and state.verify:
+            try:
+                current = xml_hash (get_config (args.name)) == \
+                    state.get_xml_hash (args.state_key)
+            except Exception:
+                current = False # e.g. deleted from the server
+
+        if current:
+            uploader.count (itemtype, 'cached')
+        else:
+            remaining.append (args)
+    return remaining
 
 JENKINS_TEST_CLASS = 'hudson.model.FreeStyleProject'
 JENKINS_PIPELINE_CLASS = 'org.jenkinsci.plugins.workflow.job.WorkflowJob'
 JENKINS_FOLDER_CLASS = 'com.cloudbees.hudson.plugins.folder.Folder'
 
-def srv_add_folder(srv, paths_set, folder):
+def _get_param_defs(properties):
+    defs = {}
+    for pr in properties or []:
+        if pr.get ('_class') == 'hudson.model.ParametersDefinitionProperty':
+            for pd in pr['parameterDefinitions']:
+                defs[pd['name']] = True
+            break
+
+    return defs
+
+def get_job_params(srv, jobname):
+    return _get_param_defs (srv.get_job_info (jobname)['property'])
+
+class JobInventory(object):
+    '''Names, classes and parameter definitions of the jobs on the server.
+    They are fetched with a single tree query on first use and updated by
+    the sync phases as they create folders and jobs, so a sync run only walks
+    the server once. Jobs deeper than "folder_depth" folders are missing.'''
+    def __init__(self, srv, folder_depth=10):
+        self.srv = srv
+        self.folder_depth = folder_depth
+        self.jobs = None
+        self.params = None
+
+    def _fetch(self):
+        query = 'jobs'
+        for _ in range (self.folder_depth):
+            query = 'jobs[name,property[parameterDefinitions[name]],{}]'.format(
+                query)
+
+        self.jobs = {
+            JENKINS_TEST_CLASS : {},
+            JENKINS_PIPELINE_CLASS : {},
+            JENKINS_FOLDER_CLASS : {},
+        }
+        self.params = {}
+        def iterate_jobs(folder, jobs):
+            for job in jobs:
+                if 'name' not in job:
+                    continue # Past the query depth
+                name = jenkins_path_join (folder, job['name'])
+                self.jobs.setdefault (job['_class'], {})[name] = True
+
+                if job['_class'] == JENKINS_FOLDER_CLASS:
+                    iterate_jobs (name, job.get ('jobs') or [])
+                else:
+                    self.params[name] = _get_param_defs (job.get ('property'))
+
+        iterate_jobs ('/', self.srv.get_info (query='?tree=' + query)['jobs'])
+
+    def get(self, jobclass):
+        '''returns a {name: True} dictionary with the jobs of "jobclass"'''
+        if self.jobs is None:
+            self._fetch()
+        return self.jobs.setdefault (jobclass, {})
+
+    def add(self, name, jobclass):
+        self.get (jobclass)[jenkins_path_join (name)] = True
+
+    def get_params(self, name):
+        if self.params is None:
+            self._fetch()
+        defs = self.params.get (name)
+        if defs is None:
+            defs = get_job_params (self.srv, name) # deeper than the query
+            self.params[name] = defs
+        return defs
+
+    def iterate(self):
+        '''yields (name, class) for every non-folder job'''
+        if self.jobs is None:
+            self._fetch()
+        for jobclass, jobs in sorted (self.jobs.items()):
+            if jobclass == JENKINS_FOLDER_CLASS:
+                continue
+            for name in sorted (jobs):
+                yield name, jobclass
+
+def srv_add_folder(srv, inventory, folder):
     folder = jenkins_path_join (folder) # canonicalization
+    paths_set = inventory.get (JENKINS_FOLDER_CLASS)
     if folder == '' or folder in paths_set:
         return False
 
@@ -207,59 +667,82 @@ def srv_add_folder(srv, paths_set, folder):
         if current not in paths_set:
             srv.create_job (current, gen.FolderData())
             # Add to the set, so next calls don't try to create the same folder.
-            paths_set[current] = True
+            inventory.add (current, JENKINS_FOLDER_CLASS)
     return True
 
-def srv_sync_jobs(srv, syncjobs, jobclass, full_jobset, validation_fn=None):
+def srv_sync_jobs(
+        srv,
+        syncjobs,
+        jobclass,
+        full_jobset,
+        validation_fn=None,
+        uploader=None,
+        inventory=None):
     '''syncs already generated Jenkins jobs (syncjobs) on a Jenkins instance
-    (src). Notice that pipelines are jobs from the Jenkins point of view'''
-    jjobs = srv.get_jobs()
-    srvjobs = {
-        JENKINS_TEST_CLASS : {},
-        JENKINS_PIPELINE_CLASS : {},
-        JENKINS_FOLDER_CLASS : {},
-    }
-    def iterate_jobs(folder, jobs):
-        for job in jobs:
-            name = jenkins_path_join (folder, job['name'])
-            srvjobs[job['_class']][name] = False
-
-            if job['_class'] == JENKINS_FOLDER_CLASS:
-                iterate_jobs (name , job['jobs'])
-                continue
-
-    iterate_jobs ('/', jjobs)
-
+    (src). Notice that pipelines are jobs from the Jenkins point of view.
+
+    Folders are created before uploading, the uploads themselves are run (and
+    their results accumulated) by "uploader". When no uploader is passed a
+    serial one is used and its summary is reported on return. "inventory" is
+    the JobInventory shared by all the sync phases, one is fetched if
+    missing.'''
+    report = uploader is None
+    uploader = uploader or SyncUploader()
+    inventory = inventory or JobInventory (srv)
+    srvjobs = inventory.get (jobclass)
+    synced = {}
+
+    tasks = []
     for job in syncjobs:
         name = job.name
 
         if validation_fn:
-            if not validation_fn (job, srvjobs):
+            if not validation_fn (job, inventory):
                 print('job "{}": failed validation. Skipping'.format (name))
                 continue
 
         dirsplit = name.rsplit ('/', 1)
         if len (dirsplit) == 2:
-            if srv_add_folder (srv, srvjobs[JENKINS_FOLDER_CLASS], dirsplit[0]):
+            if srv_add_folder (srv, inventory, dirsplit[0]):
                 print ('job "{}": added non-existent Jenkins folder: "{}"'
                     .format (name, dirsplit[0]))
 
-        if name in (srvjobs.get (jobclass) or {}):
-            srvjobs[jobclass][name] = True
+        synced[name] = True
+        if name in srvjobs:
             print('job "{}": updating'.format(name))
-            srv.reconfig_job (name, job.data)
+            tasks.append((
+                name,
+                'updated',
+                uploader.update_fn (srv.get_job_config, srv.reconfig_job, job)))
         else:
             print('job "{}": creating'.format(name))
-            srv.create_job (name, job.data)
+            tasks.append(
+                (name, 'created', uploader.create_fn (srv.create_job, job)))
+
+    uploader.run ('job', tasks)
+    for name, _, _ in tasks:
+        srvjobs[name] = True
 
-    for job, was_updated in (srvjobs.get (jobclass) or {}).items():
+    for job in sorted (srvjobs):
         # TODO force remove flag?
-        if not was_updated and job not in full_jobset:
+        if job not in synced and job not in full_jobset:
             print(
                 'WARNING. Unreferenced job "{}" exists on server'.format (job))
 
+    if report:
+        uploader.report()
+
 def gen_and_sync_tests(
-        srv, syncjson, root_folder, chunk_dirs, param_dirs, whitelist):
+        srv,
+        syncjson,
+        root_folder,
+        chunk_dirs,
+        param_dirs,
+        whitelist,
+        jobs=1,
+        uploader=None,
+        job_params=None,
+        inventory=None):
 
     jobdata_arglist = build_job_arglists(
         syncjson, root_folder, chunk_dirs, param_dirs)
@@ -269,7 +752,7 @@ def gen_and_sync_tests(
 
     full_jobset = {}
 
-    syncjobs = []
+    genargs = []
     for args in jobdata_arglist:
         name = args.name
         full_jobset[name] = True
@@ -277,42 +760,54 @@ def gen_and_sync_tests(
         if not is_in_whitelist (name, whitelist):
             continue
 
-        print('job "{}": generating'.format(name))
-
-        td = gen.TestData(
-            chunk_dirs,
-            args.board_chunk,
-            args.test_chunk,
-            args.extra_labels,
-            args.param_files)
-
-        td.add_parametrization(
-            args.inline_parametrization,
-            'sync\'s "parametrization-inline" for "{}"'.format (name))
+        genargs.append (args)
 
-        syncjobs.append (JenkinsSync (name, td))
+    render = False
+    if uploader is not None:
+        genargs = filter_unchanged(
+            'job', genargs, test_inputs_files, srv.get_job_config, uploader)
+        render = uploader.state is not None
 
-    srv_sync_jobs (srv, syncjobs, JENKINS_TEST_CLASS, full_jobset)
+    syncjobs = gen_all_data ('job', gen_test_data, genargs, jobs, render)
+    if job_params is not None:
+        for job in syncjobs:
+            job_params.add_generated(
+                job.name, unwrap_data (job.data).parameters)
 
-def get_job_params(srv, jobname):
-    defs = {}
-    for pr in srv.get_job_info (jobname)['property']:
-        if pr['_class'] == 'hudson.model.ParametersDefinitionProperty':
-            for pd in pr['parameterDefinitions']:
-                defs[pd['name']] = True
-            break
-
-    return defs
-
-def pipeline_validation(job, jobset, srv, pipelinedata_dict):
+    srv_sync_jobs(
+        srv,
+        syncjobs,
+        JENKINS_TEST_CLASS,
+        full_jobset,
+        uploader=uploader,
+        inventory=inventory)
+
+class JobParams(object):
+    '''Parameter definitions of the jobs referenced by pipelines. Jobs generated
+    on this run use their generated parameters, the rest are taken from the
+    server job inventory.'''
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.local = {}
+
+    def add_generated(self, name, parameters):
+        self.local[name] = dict ((p, True) for p in parameters)
+
+    def get(self, name):
+        defs = self.local.get (name)
+        if defs is not None:
+            return defs
+        return self.inventory.get_params (name)
+
+def pipeline_validation(job, inventory, job_params, pipelinedata_dict):
     name = job.name
     for tname, v in pipelinedata_dict[name].tests.items():
-        if tname not in (jobset.get(JENKINS_TEST_CLASS) or {}):
+        if tname not in inventory.get (JENKINS_TEST_CLASS):
             print(
                 'WARNING: On pipeline "{}". Non-existant job in server or serial branch: "{}". This WARNING can be ignored on a dry-run.'
                     .format(name, tname))
         else:
-            paramdefs = get_job_params (srv, tname)
+            paramdefs = job_params.get (tname)
             for param, val in v.params.items():
                 if param not in paramdefs:
                     print(
@@ -321,7 +816,8 @@ def pipeline_validation(job, jobset, srv, pipelinedata_dict):
     return True # Always succeed, just show warnings
 
 def gen_and_sync_pipelines(
-        srv, syncjson, root_folder, pipeline_dirs, whitelist):
+        srv, syncjson, root_folder, pipeline_dirs, whitelist, jobs=1,
+        uploader=None, job_params=None, inventory=None):
 
     pipelinedata_arglist = build_pipeline_arglists(
         syncjson, root_folder, pipeline_dirs)
@@ -331,7 +827,7 @@ def gen_and_sync_pipelines(
 
     pddict = {}
     full_jobset = {}
-    syncpipelines = []
+    genargs = []
 
     for args in pipelinedata_arglist:
         name = args.name
@@ -339,21 +835,39 @@ def gen_and_sync_pipelines(
         if not is_in_whitelist (name, whitelist):
             continue
 
-        print('pipeline "{}": generating'.format(name))
-        pd = gen.PipelineData (args.file, args.root_folder)
-        pddict[name] = pd
-        syncpipelines.append (JenkinsSync (name, pd))
+        genargs.append (args)
+
+    render = False
+    if uploader is not None:
+        genargs = filter_unchanged(
+            'job', genargs, pipeline_inputs_files, srv.get_job_config, uploader)
+        render = uploader.state is not None
 
+    syncpipelines = gen_all_data(
+        'pipeline', gen_pipeline_data, genargs, jobs, render)
+    for pipeline in syncpipelines:
+        pddict[pipeline.name] = unwrap_data (pipeline.data)
+
+    inventory = inventory or JobInventory (srv)
+    job_params = job_params or JobParams (inventory)
     srv_sync_jobs(
         srv,
         syncpipelines,
         JENKINS_PIPELINE_CLASS,
         full_jobset,
-        lambda name, jobset: pipeline_validation (name, jobset, srv, pddict))
+        lambda name, inventory: pipeline_validation(
+            name, inventory, job_params, pddict),
+        uploader,
+        inventory)
 
-def srv_sync_nodes(srv, syncnodes, whitelist):
+def srv_sync_nodes(
+        srv, syncnodes, whitelist, uploader=None, full_nodeset=None):
     '''syncs already generated Jenkins nodes (syncnodes)on a Jenkins instance
-    (srv).'''
+    (srv). See "srv_sync_jobs" for the "uploader" parameter. Nodes on
+    "full_nodeset" (e.g. skipped because they are unchanged) aren't reported
+    as unreferenced.'''
+    report = uploader is None
+    uploader = uploader or SyncUploader()
     jnodes = srv.get_nodes()
     node_updated = {}
 
@@ -363,6 +877,19 @@ def srv_sync_nodes(srv, syncnodes, whitelist):
             continue
         node_updated[name] = False
 
+    def create_node(name, data):
+        # Transient state, this interface doesn't allow to create nodes
+        # directly from XML that e.g. you saved before. Workarounding it.
+        srv.create_node(
+            name,
+            remoteFS='/tmp/nodecreate',
+            exclusive=True,
+            launcher=jenkins.LAUNCHER_COMMAND,
+            launcher_params = { "command": gen.JENKINS_NODE_CMD }
+            )
+        srv.reconfig_node (name, data)
+
+    tasks = []
     for node in syncnodes:
 
         name = node.name
@@ -372,104 +899,250 @@ def srv_sync_nodes(srv, syncnodes, whitelist):
         if name in node_updated:
             node_updated[name] = True
             print('node "{}": updating'.format(name))
+            tasks.append((
+                name,
+                'updated',
+                uploader.update_fn(
+                    srv.get_node_config, srv.reconfig_node, node)))
         else:
             print('node "{}": creating'.format(name))
-            # Transient state, this interface doesn't allow to create nodes
-            # directly from XML that e.g. you saved before. Workarounding it.
-            srv.create_node(
-                name,
-                remoteFS='/tmp/nodecreate',
-                exclusive=True,
-                launcher=jenkins.LAUNCHER_COMMAND,
-                launcher_params = { "command": gen.JENKINS_NODE_CMD }
-                )
+            tasks.append(
+                (name, 'created', uploader.create_fn (create_node, node)))
 
-        srv.reconfig_node (name, node.data)
+    uploader.run ('node', tasks)
 
     for node, updated in node_updated.items():
         # TODO force remove flag?
-        if not updated:
+        if not updated and node not in (full_nodeset or {}):
             print(
                 'WARNING. Unreferenced node "{}" exists on server'.format(node))
 
-def gen_and_sync_nodes(srv, syncjson, chunk_dirs, param_dirs, whitelist):
+    if report:
+        uploader.report()
+
+def gen_and_sync_nodes(
+        srv, syncjson, chunk_dirs, param_dirs, whitelist, jobs=1,
+        uploader=None):
     nodedata_arglist = build_node_arglists (syncjson, chunk_dirs, param_dirs)
     if len(nodedata_arglist) == 0:
         print ("sync definition file contains no nodes")
 
-    syncnodes = []
+    full_nodeset = {}
+    genargs = []
     for args in nodedata_arglist:
         name = args.name
         if name == 'master':
             raise SyncException ('node name "master" is reserved')
+        full_nodeset[name] = True
 
         if not is_in_whitelist (name, whitelist):
             continue
 
-        print('node "{}": generating'.format(name))
-        bd = gen.BoardData(
-            name, chunk_dirs, args.board_chunk, args.param_files)
-        bd.add_parametrization(
-            args.inline_parametrization,
-            'sync\'s "parametrization-inline" for "{}"'.format (name))
-        syncnodes.append (JenkinsSync (name, bd))
-
-    srv_sync_nodes (srv, syncnodes, whitelist)
-
-def build_backup(srv, syncfile, whitelist):
-    '''builds a backup of the current server\'s jobs and nodes'''
-    folder = 'hottest.bak/{}-{}'.format(
-        path.basename (syncfile), datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-
-    jobfolder = path.join (folder, 'jobs')
-    nodefolder = path.join (folder, 'nodes')
-    pipelinefolder = path.join (folder, 'pipelines')
-
-    makedirs (jobfolder)
-    makedirs (nodefolder)
-    makedirs (pipelinefolder)
-
-    print ('backing up server state to folder: "{}"'.format (folder))
-
-    jjobs = srv.get_jobs()
-
-    def iterate_jobs(rootfolder, jobs):
-        for job in jobs:
-            name = jenkins_path_join (rootfolder, job['name'])
-
-            if job['_class'] == JENKINS_FOLDER_CLASS:
-                iterate_jobs (name, job['jobs'])
-                continue
-
-            if not is_in_whitelist (name, whitelist):
-                continue
-
-            dstbase = jobfolder
-            if job['_class'] == JENKINS_PIPELINE_CLASS:
-                dstbase = pipelinefolder
+        genargs.append (args)
+
+    render = False
+    if uploader is not None:
+        genargs = filter_unchanged(
+            'node', genargs, node_inputs_files, srv.get_node_config, uploader)
+        render = uploader.state is not None
+
+    syncnodes = gen_all_data ('node', gen_node_data, genargs, jobs, render)
+    srv_sync_nodes (srv, syncnodes, whitelist, uploader, full_nodeset)
+
+BACKUP_FOLDER = 'hottest.bak'
+BACKUP_MANIFEST = 'manifest.json'
+BACKUP_MANIFEST_VERSION = 1
+
+def to_bytes(text):
+    if isinstance (text, bytes):
+        return text
+    return text.encode ('utf-8')
+
+class BackupWriter(object):
+    '''Stores the configs of a backup, either as files under a folder or as
+    members of a compressed tar archive, and records the sha1 of each of them
+    on a manifest. Not thread safe, configs are added from a single thread.
+
+    When a "previous" manifest (of a backup folder) is given, files whose
+    contents are unchanged are hard linked from it instead of written.'''
+    def __init__(self, folder, archive=False, previous=None):
+        self.folder = folder
+        self.archive = archive
+        self.previous = previous
+        self.files = {}
+        self.linked = 0
+        if archive:
+            self.filename = folder + '.tar.gz'
+            if not path.exists (path.dirname (folder)):
+                makedirs (path.dirname (folder))
+            self.tar = tarfile.open (self.filename, 'w:gz')
+        else:
+            self.filename = folder
+            self.tar = None
+            makedirs (folder)
+
+    def _try_link(self, relpath, digest):
+        if self.previous is None:
+            return False
+        if self.previous['files'].get (relpath) != digest:
+            return False
+        try:
+            link (path.join (self.previous['folder'], relpath),
+                path.join (self.folder, relpath))
+        except OSError:
+            return False # e.g. previous backup deleted, other filesystem
+        self.linked += 1
+        return True
 
-            dstfolder = path.join (dstbase, path.dirname (name))
-            if not path.exists (dstfolder):
-                makedirs(dstfolder)
+    def add(self, relpath, data):
+        data = to_bytes (data)
+        digest = hashlib.sha1 (data).hexdigest()
+        self.files[relpath] = digest
+
+        if self.tar is not None:
+            info = tarfile.TarInfo (relpath)
+            info.size = len (data)
+            info.mtime = time.time()
+            self.tar.addfile (info, BytesIO (data))
+            return
+
+        dstfolder = path.dirname (path.join (self.folder, relpath))
+        if not path.exists (dstfolder):
+            makedirs (dstfolder)
+        if self._try_link (relpath, digest):
+            return
+        with open (path.join (self.folder, relpath), 'wb') as f:
+            f.write (data)
+
+    def close(self):
+        manifest = to_bytes (json.dumps(
+            { 'version' : BACKUP_MANIFEST_VERSION, 'files' : self.files },
+            indent=1,
+            sort_keys=True))
+        if self.tar is not None:
+            self.add (BACKUP_MANIFEST, manifest)
+            del self.files[BACKUP_MANIFEST]
+            self.tar.close()
+        else:
+            with open (path.join (self.folder, BACKUP_MANIFEST), 'wb') as f:
+                f.write (manifest)
+
+def find_previous_backup(prefix):
+    '''Returns the manifest of the latest folder backup whose name starts
+    with "prefix", with its folder on the "folder" key. None if missing.'''
+    if not path.isdir (BACKUP_FOLDER):
+        return None
+    for name in sorted (listdir (BACKUP_FOLDER), reverse=True):
+        folder = path.join (BACKUP_FOLDER, name)
+        manifest = path.join (folder, BACKUP_MANIFEST)
+        if not name.startswith (prefix) or not path.isfile (manifest):
+            continue
+        with open (manifest) as f:
+            previous = json.load (f)
+        if previous.get ('version') != BACKUP_MANIFEST_VERSION:
+            continue
+        previous['folder'] = folder
+        return previous
+    return None
 
-            xml = srv.get_job_config (name)
-            with open (path.join(dstbase, name + '.xml'), "w") as f:
-                f.write(xml)
+def build_backup(
+        srv,
+        syncfile,
+        whitelist,
+        inventory=None,
+        max_requests=1,
+        archive=False,
+        incremental=False):
+    '''builds a backup of the current server\'s jobs and nodes
+
+    Configs are downloaded by up to "max_requests" concurrent requests and
+    written as soon as they arrive. With "archive" the backup is a single
+    .tar.gz file. With "incremental" configs unchanged since the previous
+    folder backup are hard linked to it. Both have a manifest with the sha1
+    of every config.'''
+    prefix = path.basename (syncfile) + '-'
+    folder = path.join(
+        BACKUP_FOLDER,
+        prefix + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+
+    previous = None
+    if incremental and not archive:
+        previous = find_previous_backup (prefix)
+
+    tasks = []
+    inventory = inventory or JobInventory (srv)
+    for name, jobclass in inventory.iterate():
+        if not is_in_whitelist (name, whitelist):
+            continue
 
-    iterate_jobs('', jjobs)
+        dstbase = 'jobs'
+        if jobclass == JENKINS_PIPELINE_CLASS:
+            dstbase = 'pipelines'
+        tasks.append ((dstbase + '/' + name + '.xml', srv.get_job_config, name))
 
-    jnodes = srv.get_nodes()
-    for node in jnodes:
+    for node in srv.get_nodes():
         name = node['name']
         if name == 'master' or not is_in_whitelist (name, whitelist):
             continue
-        xml  = srv.get_node_config(name)
-        with open(path.join(nodefolder, name + '.xml'), "w") as f:
-            f.write(xml)
+        tasks.append (('nodes/' + name + '.xml', srv.get_node_config, name))
+
+    writer = BackupWriter (folder, archive, previous)
+    print ('backing up server state to: "{}"'.format (writer.filename))
 
+    def fetch(task):
+        relpath, get_config, name = task
+        try:
+            return relpath, get_config (name), None
+        except Exception as e:
+            return relpath, None, e
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool (max (1, min (max_requests, len (tasks))))
+    failures = []
+    try:
+        for relpath, xml, error in pool.imap_unordered (fetch, tasks):
+            if error is not None:
+                print ('backup "{}": failed: {}'.format(
+                    relpath, getattr (error, 'msg', error)))
+                failures.append (relpath)
+                continue
+            writer.add (relpath, xml)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+
+    if len (failures) > 0:
+        raise SyncException(
+            '{} item(s) failed to backup'.format (len (failures)))
+
+    if previous is not None:
+        print ('backup: {} of {} configs unchanged since "{}"'.format(
+            writer.linked, len (tasks), previous['folder']))
     print ("backup done")
 
-def build_jenkins_sync(rpath, basedir, filterexpr):
+class BackupData(object):
+    '''A backed up Jenkins XML configuration'''
+    def __init__(self, xml):
+        self.xml = xml
+
+    def get_jenkins_xml(self):
+        return self.xml
+
+    def __str__(self):
+        return self.xml
+
+def backup_item(relpath, data, manifest):
+    '''builds a "JenkinsSync" from a backed up file on "relpath" (e.g.
+    "jobs/folder/job.xml"), checking its contents against the manifest.'''
+    digest = manifest.get (relpath)
+    if digest is not None and digest != hashlib.sha1 (data).hexdigest():
+        raise SyncException(
+            'backup file "{}" doesn\'t match its manifest hash'.format (relpath))
+    name = path.splitext (relpath.split ('/', 1)[1])[0]
+    return JenkinsSync (name, BackupData (data.decode ('utf-8')))
+
+def build_jenkins_sync(rpath, basedir, filterexpr, manifest={}):
     '''builds a list of "JenkinsSync" operations by globing the files present
     on a directory (e.g. backup)'''
 
@@ -477,20 +1150,57 @@ def build_jenkins_sync(rpath, basedir, filterexpr):
     startpath = path.join (path.abspath (rpath), basedir)
     for root, dirs, files in walk (startpath):
         for file in fnmatch.filter (files, filterexpr):
-            name = path.splitext (file)[0]
             jenkinspath = root[len (startpath) + 1:]
-
+            relpath = basedir + '/' + file
             if jenkinspath != '' and jenkinspath != '/':
-                name = jenkinspath + '/' + name
+                relpath = basedir + '/' + jenkinspath + '/' + file
 
-            with open (path.join (root, file), 'r') as f:
-                sync.append (JenkinsSync (name, f.read()))
+            with open (path.join (root, file), 'rb') as f:
+                sync.append (backup_item (relpath, f.read(), manifest))
     return sync
 
-def revert_from_backup(srv, rpath):
-    nodes = build_jenkins_sync (rpath, 'nodes', '*.xml')
-    jobs  = build_jenkins_sync (rpath, 'jobs', '*.xml')
-    pipelines = build_jenkins_sync (rpath, 'pipelines', '*.xml')
+def read_backup_archive(filename):
+    '''returns a {basedir: ["JenkinsSync"]} dictionary with the contents of
+    a backup archive.'''
+    items = {}
+    with tarfile.open (filename, 'r:*') as tar:
+        manifest = {}
+        try:
+            manifest = json.loads(
+                tar.extractfile (BACKUP_MANIFEST).read().decode ('utf-8'))
+            manifest = manifest['files']
+        except KeyError:
+            pass # older backup, no manifest
+        for member in tar:
+            relpath = member.name
+            if not member.isfile() or not fnmatch.fnmatch (relpath, '*/*.xml'):
+                continue
+            data = tar.extractfile (member).read()
+            items.setdefault (relpath.split ('/', 1)[0], []).append(
+                backup_item (relpath, data, manifest))
+    return items
+
+def read_backup(rpath):
+    '''returns the (nodes, jobs, pipelines) "JenkinsSync" lists of a backup
+    folder or archive'''
+    if path.isfile (rpath):
+        items = read_backup_archive (rpath)
+        return tuple(
+            items.get (d, []) for d in ('nodes', 'jobs', 'pipelines'))
+
+    manifest = {}
+    if path.isfile (path.join (rpath, BACKUP_MANIFEST)):
+        with open (path.join (rpath, BACKUP_MANIFEST)) as f:
+            manifest = json.load (f)['files']
+    return tuple(
+        build_jenkins_sync (rpath, d, '*.xml', manifest)
+        for d in ('nodes', 'jobs', 'pipelines'))
+
+def revert_from_backup(srv, rpath, max_requests=1, full=False):
+    '''pushes a backup (folder or archive) to the server. Unless "full" is
+    set only the items whose configuration differs from the server are
+    pushed, using up to "max_requests" concurrent requests.'''
+    nodes, jobs, pipelines = read_backup (rpath)
 
     if len (nodes) == 0 and len (jobs) == 0 and len (pipelines) == 0:
         print(
@@ -498,9 +1208,19 @@ def revert_from_backup(srv, rpath):
                 .format(rpath, rpath))
         return
 
-    srv_sync_nodes (srv, nodes, [])
-    srv_sync_jobs (srv, jobs, [], JENKINS_TEST_CLASS)
-    srv_sync_jobs (srv, pipelines, [], JENKINS_PIPELINE_CLASS)
+    uploader = SyncUploader (max_requests, not full)
+    inventory = JobInventory (srv)
+    srv_sync_nodes (srv, nodes, [], uploader)
+    srv_sync_jobs(
+        srv, jobs, JENKINS_TEST_CLASS, {}, uploader=uploader, inventory=inventory)
+    srv_sync_jobs(
+        srv,
+        pipelines,
+        JENKINS_PIPELINE_CLASS,
+        {},
+        uploader=uploader,
+        inventory=inventory)
+    uploader.report()
 
 def jenkins_sync(
         srv,
@@ -510,19 +1230,54 @@ def jenkins_sync(
         param_dirs,
         pipeline_dirs,
         mode,
-        whitelist):
+        whitelist,
+        jobs=1,
+        max_requests=1,
+        full=False,
+        state=None,
+        backup_archive=False,
+        backup_incremental=False):
 
     sync = parse_json(syncfile, thisfile_dirname_join('_schema_sync.json'))
+    uploader = SyncUploader (max_requests, not full, state)
+    inventory = JobInventory (srv)
+    job_params = JobParams (inventory)
     if 'b' in mode:
-        build_backup (srv, syncfile, whitelist)
+        build_backup(
+            srv,
+            syncfile,
+            whitelist,
+            inventory,
+            max_requests,
+            backup_archive,
+            backup_incremental)
     if 'n' in mode:
-        gen_and_sync_nodes (srv, sync, chunk_dirs, param_dirs, whitelist)
+        gen_and_sync_nodes(
+            srv, sync, chunk_dirs, param_dirs, whitelist, jobs, uploader)
     if 't' in mode:
         gen_and_sync_tests(
-            srv, sync, root_folder, chunk_dirs, param_dirs, whitelist)
+            srv,
+            sync,
+            root_folder,
+            chunk_dirs,
+            param_dirs,
+            whitelist,
+            jobs,
+            uploader,
+            job_params,
+            inventory)
     if 'p' in mode:
         gen_and_sync_pipelines(
-            srv, sync, root_folder, pipeline_dirs, whitelist)
+            srv,
+            sync,
+            root_folder,
+            pipeline_dirs,
+            whitelist,
+            jobs,
+            uploader,
+            job_params,
+            inventory)
+    uploader.report()
 
 def append_subdirs(dirlist, subdir):
     dirs = []
@@ -533,7 +1288,8 @@ def append_subdirs(dirlist, subdir):
     return dirs
 
 def run_sync(args):
-    if args.dry_run or args.dry_run_xml or args.dry_run_metadata:
+    dry_run = args.dry_run or args.dry_run_xml or args.dry_run_metadata
+    if dry_run:
         srvtype = DryRunJenkins
         args.mode = args.mode.replace ('b','') # don't backup on dry runs
     else:
@@ -548,6 +1304,12 @@ def run_sync(args):
     if args.dry_run_metadata:
         srv.dump_type = 'metadata'
 
+    if args.skip_revalidation:
+        enable_validation_cache()
+
+    if args.max_requests > 1:
+        srv_set_max_connections (srv, args.max_requests)
+
     cki = args.chunk_include
     pri = args.parametrization_include
     ppi = args.pipeline_include
@@ -559,23 +1321,44 @@ def run_sync(args):
     if len (cki) == 0:
         raise SyncException ('No chunk include dir was passed.')
 
-    jenkins_sync(
-        srv,
-        args.sync_file,
-        args.root_folder,
-        cki,
-        pri,
-        ppi,
-        args.mode,
-        args.item_whitelist)
+    # Dry runs dump every item, so they neither use the sync state nor skip
+    # the items unchanged on the server.
+    state = None
+    if not dry_run:
+        state = SyncState(
+            sync_state_filename (args.jenkins_url, args.root_folder),
+            args.verify)
+    try:
+        jenkins_sync(
+            srv,
+            args.sync_file,
+            args.root_folder,
+            cki,
+            pri,
+            ppi,
+            args.mode,
+            args.item_whitelist,
+            args.jobs,
+            args.max_requests,
+            args.full or dry_run,
+            state,
+            args.backup_archive,
+            args.backup_incremental)
+    finally:
+        if state is not None:
+            state.save()
 
     if args.dry_run or args.dry_run_xml:
         print('\nWARNING: "dry-run" was enabled. No modifications were done.')
 
 def run_revert(args):
-    srv = jenkins.Jenkins(
+    srv = JenkinsWrapper(
         args.jenkins_url, username=args.jenkins_user, password=args.jenkins_pwd)
-    revert_from_backup (srv, args.backup_path)
+    if args.max_requests > 1:
+        srv_set_max_connections (srv, args.max_requests)
+    # The reverted configs don't match what the sync state recorded as pushed.
+    drop_sync_states (args.jenkins_url)
+    revert_from_backup (srv, args.backup_path, args.max_requests, args.full)
 
 def main():
     p = ArgumentParser('syncs with a Jenkins server')
@@ -667,6 +1450,58 @@ def main():
         default=False,
         help='Doesn\'t issue modifications on the remote jenkins server. Dumps parseable metadata on stdout')
 
+    syncp.add_argument(
+        '-j', '--jobs',
+        action='store',
+        type=int,
+        required=False,
+        default=1,
+        help='Number of worker processes used to generate nodes, tests and pipelines.')
+
+    syncp.add_argument(
+        '--full',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Generates and uploads every item, even the ones whose inputs or configuration on the server are unchanged.')
+
+    syncp.add_argument(
+        '--verify',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Checks that the configuration on the server of the items with unchanged inputs matches the one recorded on the local sync state. Items not matching are regenerated and uploaded. The local sync state (under "{}") only knows about the syncs done from this directory: without this flag (or "--full") items edited or deleted on the server by hand are skipped until their inputs change. "revert" drops the sync state of its server.'
+            .format (SYNC_STATE_FOLDER))
+
+    syncp.add_argument(
+        '--max-requests',
+        action='store',
+        type=int,
+        required=False,
+        default=1,
+        help='Maximum number of concurrent upload requests to the Jenkins server.')
+
+    syncp.add_argument(
+        '--skip-revalidation',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Skips the schema validation of files whose contents were already validated during this run.')
+
+    syncp.add_argument(
+        '--backup-archive',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Stores the backup as a single compressed (.tar.gz) archive instead of a folder.')
+
+    syncp.add_argument(
+        '--backup-incremental',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Hard links the configs unchanged since the previous backup folder of the same sync file instead of storing them again. Ignored with "--backup-archive".')
+
     syncp.add_argument(
         '-r', '--root-folder',
         action='store',
@@ -681,7 +1516,22 @@ def main():
         '-b', '--backup-path',
         action='store',
         required=True,
-        help='Root of the backed up path.')
+        help='Root of the backed up path or backup archive (.tar.gz).')
+
+    revertp.add_argument(
+        '--max-requests',
+        action='store',
+        type=int,
+        required=False,
+        default=1,
+        help='Maximum number of concurrent requests to the Jenkins server.')
+
+    revertp.add_argument(
+        '--full',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Pushes every backed up item, even the ones whose configuration on the server is unchanged.')
     revertp.set_defaults(func=run_revert)
 
     args = p.parse_args()
@@ -1,7 +1,12 @@
 # Class to interact with the hush (e.g. Uboot) shell
 
+import sys
 import time
+import errno
+import types
+import select
 import string
+from contextlib import contextmanager
 
 class HushError(Exception):
     pass
@@ -36,29 +41,253 @@ class HushCommandFailed(HushError):
             command, error_code, '\n'.join(output_line_list))
         super (HushCommandFailed, self).__init__(msg_str)
 
+class HushDisconnected(HushError):
+    def __init__(self):
+        super(HushDisconnected, self).__init__(
+            'shell: serial port readable but without data, disconnected?')
+
 class HushShellDelays():
+    ''' Delays (seconds) used when talking to a shell. Commands are written in
+    blocks of "block" characters (the UART FIFO size of the target), waiting
+    for the echo of each block before writing the next one. "char" is only
+    slept between characters once a board fell back to per character writes.
+    Both are updated by HushShell when echo mismatches are detected, so an
+    instance reused for the same board keeps what was learned. '''
     def __init__(
             self,
             cmd=0.1,
             abort=0.3,
-            char=0.001):
+            char=0.001,
+            block=16):
 
         self.cmd   = float(cmd)
         self.char  = float(char)
         self.abort = float(abort)
+        self.block = int(block)
+
+class Return(Exception):
+    ''' Raised by a coroutine run by "HushLoop" to return a value, Python 2
+    generators can't "return" one. '''
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+class HushTask(object):
+    ''' A coroutine run by "HushLoop". Coroutines are generators that yield:
+    - another coroutine: to run it and get its result (see "Return") or
+        exception back on the "yield" expression.
+    - a (waitable, deadline) tuple: to be resumed when "waitable" (anything
+        with a "fileno", or None to just sleep) is readable or when the
+        absolute time "deadline" (or None for no deadline) is reached. '''
+    def __init__(self, coroutine):
+        self.stack = [coroutine]
+        self.waitable = None
+        self.deadline = None
+        self.done = False
+        self.result = None
+        self.exc_info = None
+
+    def step(self):
+        ''' Runs the task until its next wait or until it finishes. '''
+        value = None
+        exc_info = None
+        while self.stack:
+            try:
+                if exc_info is not None:
+                    wait = self.stack[-1].throw(*exc_info)
+                else:
+                    wait = self.stack[-1].send(value)
+            except Return as ret:
+                self.stack.pop()
+                value, exc_info = ret.value, None
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value, exc_info = None, None
+                continue
+            except Exception:
+                self.stack.pop()
+                value, exc_info = None, sys.exc_info()
+                continue
+
+            if isinstance(wait, types.GeneratorType):
+                self.stack.append(wait)
+                value, exc_info = None, None
+                continue
+
+            self.waitable, self.deadline = wait
+            return
+
+        self.done = True
+        self.result = value
+        self.exc_info = exc_info
+
+class HushLoop(object):
+    ''' Runs coroutines (e.g. the "*_async" methods of HushShell) concurrently
+    on a single thread. A single "select" waits for all their serial ports
+    with the exact time left to the closest deadline. '''
+    # Waitables without a file descriptor (e.g. non POSIX serial ports) are
+    # polled at this interval (seconds).
+    POLL_INTERVAL = 0.01
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine):
+        ''' Adds a coroutine to the loop and returns its HushTask. '''
+        task = HushTask(coroutine)
+        self.tasks.append(task)
+        task.step()
+        return task
+
+    def run_once(self):
+        ''' Waits until at least a task can run and runs the ready ones. '''
+        readers = {}
+        deadlines = []
+        for task in self.tasks:
+            if task.deadline is not None:
+                deadlines.append(task.deadline)
+            if task.waitable is not None:
+                try:
+                    fd = task.waitable.fileno()
+                except (AttributeError, ValueError, IOError):
+                    fd = None
+                    deadlines.append(time.time() + self.POLL_INTERVAL)
+                readers.setdefault(fd, []).append(task)
+        timeout = max(min(deadlines) - time.time(), 0) if deadlines else None
+
+        fds = [fd for fd in readers if fd is not None]
+        if fds:
+            try:
+                ready = select.select(fds, [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                ready = []
+        else:
+            if timeout is not None:
+                time.sleep(timeout)
+            ready = []
+
+        now = time.time()
+        runnable = [task for fd in ready for task in readers[fd]]
+        runnable += readers.get(None, [])
+        runnable += [
+            task for task in self.tasks
+            if not task.done and task not in runnable
+                and task.deadline is not None and task.deadline <= now]
+        for task in runnable:
+            if not task.done:
+                task.step()
+
+        self.tasks = [task for task in self.tasks if not task.done]
+
+    def run(self):
+        ''' Runs until all the tasks are done. '''
+        while self.tasks:
+            self.run_once()
+
+    def run_until_complete(self, coroutine):
+        ''' Runs the coroutine to completion. Returns its result or raises its
+        exception. '''
+        task = self.spawn(coroutine)
+        while not task.done:
+            self.run_once()
+        if task.exc_info is not None:
+            raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        return task.result
+
+def sleep_async(seconds):
+    ''' Coroutine that sleeps without blocking the loop. '''
+    until = time.time() + seconds
+    while time.time() < until:
+        yield (None, until)
+
+class _SerialBuffer(object):
+    ''' Input buffer of a serial port. Reads get all the data available at
+    once, lines are split from a reusable bytearray. '''
+    def __init__(self, serial):
+        self.serial = serial
+        self.buf = bytearray()
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def _readable(self):
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, ValueError, IOError):
+            return False
+        return bool(select.select([fd], [], [], 0)[0])
+
+    def read_available(self):
+        available = self.serial.in_waiting
+        if available:
+            self.buf += self.serial.read(available)
+        elif self._readable():
+            # Readable with nothing waiting: a hangup or an unplugged
+            # adapter. Waiting again would return right away, read to get
+            # its error (pyserial raises) instead of spinning.
+            data = self.serial.read(1)
+            if not data:
+                raise HushDisconnected()
+            self.buf += data
+            available = len(data)
+        return available
+
+    def take_line(self):
+        ''' Returns the next complete line or None. '''
+        end = self.buf.find('\n')
+        if end < 0:
+            return None
+        line = str(self.buf[:end + 1])
+        del self.buf[:end + 1]
+        return line
+
+    def take_all(self):
+        data = str(self.buf)
+        del self.buf[:]
+        return data
+
+    def endswith(self, data):
+        return self.buf.endswith(data)
+
+    def find(self, data):
+        return self.buf.find(data)
 
 class HushShell(object):
-    ''' Interact with U-boot hushshell over a serial link '''
+    ''' Interact with U-boot hushshell over a serial link.
+
+    The shell is driven by coroutines (the "*_async" methods) that wait on the
+    serial port with "select" until data arrives or their deadline expires,
+    so many shells can be driven concurrently from a "HushLoop". The blocking
+    methods run them on a private loop. '''
     # String to look for to determine return code of a U-boot command
     RETCODE_KEYWORD = 'RETCODE '
+    # Longest line written by "command_batch". U-Boot's console buffer
+    # (CONFIG_SYS_CBSIZE) is 256 bytes on most boards, but it takes at most
+    # CBSIZE - 2 typed characters (CBSIZE - 1 with line editing) and
+    # truncates the rest.
+    MAX_LINE_LENGTH = 254
+    # Times a command is written again after an echo mismatch, writing slower
+    # each time.
+    ECHO_RETRIES = 3
+    # Upper bound for the learned inter-character delay.
+    MAX_CHAR_DELAY = 0.05
     # Minimum elapsed time (seconds) between each command invokation (enforced)
 
-    def __init__(self, serial, logger, delays=HushShellDelays()):
+    def __init__(self, serial, logger, delays=None):
         self.serial = serial
+        self.input = _SerialBuffer(serial)
         self.last_cmd_timepoint = 0
         self.last_cmd = None
         self.log = logger
-        self.delay = delays
+        # Learned delays are updated in place, never share a default one.
+        self.delay = delays if delays is not None else HushShellDelays()
+        # In a session the shell is only reconnected (see "connect") when a
+        # command leaves it in an unknown state.
+        self.in_session = False
+        self.synced = False
         ''' It is essential that a serial port read() doesn't block too long,
         otherwise we might not be able to send CTRL+C during the (relatively)
         short window where it is possible to break into U-boot shell. '''
@@ -67,84 +296,208 @@ class HushShell(object):
     def set_delays(self, delays):
         self.delay = delays
 
+    def fileno(self):
+        ''' Lets coroutines wait for serial port input with a
+        (HushShell, deadline) tuple. '''
+        return self.input.fileno()
+
+    def _run(self, coroutine):
+        return HushLoop().run_until_complete(coroutine)
+
+    def pop_received(self):
+        ''' Returns (and forgets) the data read from the port that the shell
+        didn't consume, e.g. the output following a "command_raw". '''
+        self.input.read_available()
+        return self.input.take_all()
+
     def _reset_serial_buffers(self):
         self.log.debug("shell: resetting buffers")
         self.serial.reset_output_buffer()
         self.serial.reset_input_buffer()
+        self.input.take_all()
+
+    def _readline_async(self, deadline):
+        ''' Coroutine returning the next line read, or None if "deadline"
+        expires first. '''
+        while True:
+            line = self.input.take_line()
+            if line is not None:
+                raise Return(line)
+            if time.time() >= deadline:
+                raise Return(None)
+            yield (self.input, deadline)
+            self.input.read_available()
 
     def send_abort(self):
+        self._run(self._send_abort_async())
+
+    def _send_abort_async(self):
         self.log.debug("shell: send abort sequence")
         self.serial.write("\x03")
         self.serial.flush()
-        time.sleep(self.delay.abort)
+        yield sleep_async(self.delay.abort)
 
     def connect(self, timeout):
         ''' Clears the serial port buffers and waits until hush shell (uboot) is
         ready/responsive/operational. '''
+        self._run(self.connect_async(timeout))
+
+    def connect_async(self, timeout):
+        ''' Coroutine version of "connect". '''
         start = time.time()
         while True:
             self._reset_serial_buffers()
-            self.send_abort()
-            line = self.serial.readline()
-            if '<INTERRUPT>' in line:
+            yield self._send_abort_async()
+            line = yield self._readline_async(time.time() + self.serial.timeout)
+            if line is not None and '<INTERRUPT>' in line:
                 self.log.debug('shell: operational')
                 break
             elif time.time() - start > timeout:
                 raise HushWaitTimeout()
         self.serial.write('\n')
-        time.sleep(self.delay.abort * 2)
+        yield sleep_async(self.delay.abort * 2)
         self._reset_serial_buffers()
+        self.synced = True
+
+    @contextmanager
+    def session(self, timeout):
+        ''' Connects to the shell once for all the commands run inside the
+        "with" block. Successful commands and commands that fail with a
+        return code leave the shell on a known state (a prompt after the
+        RETCODE line), so the next one is written right away. Any other error
+        or a "command_raw" makes the next command connect again.
+
+        May throw HushWaitTimeout: No connection to Uboot shell. '''
+        self.connect(timeout)
+        self.in_session = True
+        try:
+            yield self
+        finally:
+            self.in_session = False
+
+    def _sync_async(self, timeout):
+        if self.in_session and self.synced:
+            # The previous command ended on a prompt, just drop the prompt
+            # and anything printed after it.
+            self.serial.reset_input_buffer()
+            self.input.take_all()
+        else:
+            yield self.connect_async(timeout)
 
-    def _write_command(self, cmd, will_parse=True, echo_timeout=4):
+    def _write_command_async(self, cmd, will_parse=True, echo_timeout=4):
         if self.last_cmd:
             self.log.warning(
                 'shell: possible bug, a command generating retcodes didn\'t have a subsequent call to "parse_output"')
 
+        if will_parse:
+            sendcmd = cmd + " ; echo {}$?".format(self.RETCODE_KEYWORD)
+        else:
+            sendcmd = cmd
+
+        self.last_cmd = None
+        yield self._write_line_async(sendcmd, cmd, echo_timeout)
+        self.last_cmd = cmd if will_parse else None
+
+    def _write_line_async(self, sendcmd, cmd, echo_timeout):
         #Apply delay between commands, some shells require it
         last_cmd_elapsed_sec = time.time() - self.last_cmd_timepoint
         if last_cmd_elapsed_sec < self.delay.cmd:
             delay = float(self.delay.cmd - last_cmd_elapsed_sec)
             self.log.debug(
                 'shell: %fs delay before issuing next command', delay)
-            time.sleep(delay)
+            yield sleep_async(delay)
 
         start = time.time()
-        self.connect(echo_timeout)
-
-        if will_parse:
-            sendcmd = cmd + " ; echo {}$?".format(self.RETCODE_KEYWORD)
-        else:
-            sendcmd = cmd
+        deadline = start + echo_timeout
+        yield self._sync_async(echo_timeout)
 
-        # Send command string with inter-character delay to improve buggy
-        # behavior on some ports
-        for character in sendcmd + '\n':
-            self.serial.write(character)
-            if self.delay.char > 0:
-                time.sleep(self.delay.char)
-
-        self.last_cmd = None
-        self.last_cmd_timepoint = time.time()
+        attempt = 0
+        while True:
+            echo = yield self._write_echoed_async(sendcmd, deadline)
+            self.last_cmd_timepoint = time.time()
+            if echo is not None and echo.endswith(sendcmd):
+                break
+            if echo is None:
+                raise HushTimeout(cmd)
+            if attempt == self.ECHO_RETRIES or time.time() >= deadline:
+                printable_echo = "".join(
+                    [x for x in echo if x in string.printable])
+                raise HushCommandEchoMismatch(cmd, printable_echo)
+            attempt += 1
+            self._slow_down_writes()
+            # Ctrl+C discards the partially written line.
+            yield self.connect_async(deadline - time.time())
 
         self.log.debug('shell: write command: "%s"', cmd)
-        remaining_time = echo_timeout - (time.time() - start)
-        if remaining_time <= 0:
-            raise HushTimeout(cmd)
-
-        tmo = self.serial.timeout
-        self.serial.timeout = remaining_time
-        echo = self.serial.readline().rstrip()
-        self.serial.timeout = tmo
+        self.log.debug('shell: successfully written command: "%s"', cmd)
 
-        if not echo.endswith(sendcmd):
-            printable_echo = "".join(
-                [x for x in echo if x in string.printable])
-            raise HushCommandEchoMismatch(cmd, printable_echo)
+    def _slow_down_writes(self):
+        if self.delay.block > 1:
+            self.log.warning(
+                'shell: echo mismatch writing blocks of %d characters, falling back to per character writes',
+                self.delay.block)
+            self.delay.block = 1
+        else:
+            self.delay.char = min(
+                max(self.delay.char * 2, 0.001), self.MAX_CHAR_DELAY)
+            self.log.warning(
+                'shell: echo mismatch, inter-character delay raised to %fs',
+                self.delay.char)
+
+    def _read_echo_async(self, expected, deadline):
+        ''' Coroutine returning the data received until it ends with
+        "expected". A late echo is waited for until "deadline", but once the
+        echo started it gives up when no more data arrives for the time it
+        takes to echo "expected" (a mismatch, e.g. characters dropped by the
+        target). Data before the first character of "expected" (e.g. a
+        prompt) isn't part of the echo. '''
+        settle = self._echo_wait(expected)
+        last_data = None
+        while not self.input.endswith(expected):
+            wait = deadline
+            if last_data is not None:
+                wait = min(deadline, last_data + settle)
+            if time.time() >= wait:
+                break
+            yield (self.input, wait)
+            if (self.input.read_available() and
+                    self.input.find(expected[0]) >= 0):
+                last_data = time.time()
+        raise Return(self.input.take_all())
+
+    def _write_echoed_async(self, sendcmd, deadline):
+        ''' Writes a command line in blocks of "delay.block" characters. Each
+        block is only written once the previous one was echoed, so the target
+        input FIFO can't overflow and a mismatch is detected at the block
+        where it happens. Returns what was echoed until the line ended or a
+        block's echo differed, None if nothing was echoed in time. '''
+        block = max(self.delay.block, 1)
+        echo = ''
+        for i in range(0, len(sendcmd), block):
+            chunk = sendcmd[i:i + block]
+            self.serial.write(chunk)
+            if block == 1 and self.delay.char > 0:
+                yield sleep_async(self.delay.char)
+            # The prompt may precede the echo of the first block.
+            chunk_echo = yield self._read_echo_async(chunk, deadline)
+            echo += chunk_echo
+            if not echo.endswith(chunk):
+                raise Return(echo if chunk_echo else None)
+
+        # The command output follows the end of the line, it is left on the
+        # buffer.
+        self.serial.write('\n')
+        line = yield self._readline_async(deadline)
+        if line is None:
+            raise Return(echo)
+        raise Return((echo + line).rstrip())
 
-        self.log.debug('shell: successfully written command: "%s"', cmd)
-        self.last_cmd = cmd if will_parse else None
+    def _echo_wait(self, chunk):
+        # Time to transmit and echo back a block plus some processing slack.
+        baudrate = getattr(self.serial, 'baudrate', None) or 9600
+        return 0.2 + 2 * len(chunk) * 10.0 / baudrate
 
-    def _parse_output(self, timeout=4):
+    def _parse_output_async(self, timeout=4):
         if self.last_cmd is None:
             raise HushError(
                 'shell: can\'t invoke "parse_output" without a previous successful invocation of "write_command"')
@@ -153,35 +506,44 @@ class HushShell(object):
         self.last_cmd = None
         self.log.debug('shell: parse command result of: "%s"', cmd)
 
+        retcode, lines = yield self._read_retcode_async(cmd, timeout)
+        if retcode != 0:
+            raise HushCommandFailed(cmd, retcode, lines)
+        self.log.debug('shell: parse command successful: "{}"'.format (cmd))
+        raise Return(lines)
+
+    def _read_retcode_async(self, cmd, timeout):
+        ''' Reads the output of a command until its RETCODE line. Returns the
+        return code and the output lines. '''
         lines = []
-        start = time.time()
+        deadline = time.time() + timeout
         while True:
-            line = self.serial.readline()
-            now = time.time()
+            line = yield self._readline_async(deadline)
 
-            if now - start >= timeout:
+            if line is None:
                 self.log.debug('shell: no response in %f s', timeout)
-                self.send_abort()
+                yield self._send_abort_async()
                 raise HushTimeout('(parsing output of) {}'.format(cmd))
 
-            if not line:
-                continue
-
             line = line.strip()
             if line.startswith(self.RETCODE_KEYWORD):
-                retcode = int(line[len(self.RETCODE_KEYWORD):])
-                if retcode == 0:
-                    break
-                else:
-                    raise HushCommandFailed(cmd, retcode, lines)
+                raise Return((int(line[len(self.RETCODE_KEYWORD):]), lines))
             elif line.upper().startswith('UNKNOWN COMMAND'):
-                self.send_abort()
+                yield self._send_abort_async()
                 raise HushUnknownCommand(cmd)
             else:
                 self.log.debug('shell: <- "{}"'.format(line))
                 lines.append(line)
-        self.log.debug('shell: parse command successful: "{}"'.format (cmd))
-        return lines
+
+    def _unsync_on_error_async(self, coroutine):
+        try:
+            result = yield coroutine
+        except HushCommandFailed:
+            raise
+        except:
+            self.synced = False
+            raise
+        raise Return(result)
 
     def command(self, cmd, timeout=4):
         ''' Executes the given command and tries parse (and consumes) the output
@@ -198,19 +560,87 @@ class HushShell(object):
         - HushCommandFailed: The command failed. The exception contains the
             error code and output.
         - HushUnknownCommand: The command was unknown '''
+        return self._run(self.command_async(cmd, timeout))
+
+    def command_async(self, cmd, timeout=4):
+        ''' Coroutine version of "command". '''
+        return self._unsync_on_error_async(self._command_async(cmd, timeout))
+
+    def _command_async(self, cmd, timeout):
         start = time.time()
-        self._write_command(cmd, True, timeout)
+        yield self._write_command_async(cmd, True, timeout)
         elapsed = time.time() - start
         remaining = timeout - elapsed
-        return self._parse_output(remaining if remaining > 0 else 0)
+        lines = yield self._parse_output_async(remaining if remaining > 0 else 0)
+        raise Return(lines)
+
+    def _batch_lines(self, cmds):
+        ''' Groups commands on as few lines as "MAX_LINE_LENGTH" allows.
+        Returns the lines as (sendcmd, commands) tuples. '''
+        ok = ' && echo {}0'.format(self.RETCODE_KEYWORD)
+        fail = ' || echo {}$?'.format(self.RETCODE_KEYWORD)
+        lines = []
+        group = []
+        for cmd in cmds:
+            sendcmd = ' && '.join([c + ok for c in group + [cmd]]) + fail
+            if group and len(sendcmd) > self.MAX_LINE_LENGTH:
+                lines.append(group)
+                group = []
+            group.append(cmd)
+        if group:
+            lines.append(group)
+        return [
+            (' && '.join([c + ok for c in group]) + fail, group)
+            for group in lines]
+
+    def command_batch(self, cmds, timeout=4):
+        ''' Executes a list of commands, with the same semantics as calling
+        "command" for each of them but writing them on as few lines as
+        possible. The commands on a line are chained with "&&" and followed
+        by a RETCODE echo each, so the first failing one stops the rest of the
+        batch. All the output is parsed on a single read loop. "timeout"
+        applies to each command.
+
+        Returns a list with the output lines of each command. May throw the
+        same exceptions as "command". '''
+        return self._run(self.command_batch_async(cmds, timeout))
+
+    def command_batch_async(self, cmds, timeout=4):
+        ''' Coroutine version of "command_batch". '''
+        return self._unsync_on_error_async(
+            self._command_batch_async(cmds, timeout))
+
+    def _command_batch_async(self, cmds, timeout):
+        outputs = []
+        for sendcmd, group in self._batch_lines(cmds):
+            start = time.time()
+            yield self._write_line_async(sendcmd, group[0], timeout)
+            deadline = start + timeout
+            for cmd in group:
+                self.log.debug('shell: parse command result of: "%s"', cmd)
+                retcode, lines = yield self._read_retcode_async(
+                    cmd, max(deadline - time.time(), 0))
+                if retcode != 0:
+                    raise HushCommandFailed(cmd, retcode, lines)
+                outputs.append(lines)
+                deadline = time.time() + timeout
+        raise Return(outputs)
 
     def command_raw(self, cmd, timeout=4):
         ''' Executes the given command without looking at the results or parsing
         the output. Cleans the serial port buffers before writing the command.
+        The output already read is available from "pop_received".
 
         May throw:
         - HushWaitTimeout: No connection to Uboot shell.
         - HushTimeout: Timeout expired
         - HushCommandEchoMismatch: The echoed command on the shell didn't match
         '''
-        self._write_command(cmd, False, timeout)
+        self._run(self.command_raw_async(cmd, timeout))
+
+    def command_raw_async(self, cmd, timeout=4):
+        ''' Coroutine version of "command_raw". '''
+        yield self._unsync_on_error_async(
+            self._write_command_async(cmd, False, timeout))
+        # Nothing tells when the command finishes.
+        self.synced = False
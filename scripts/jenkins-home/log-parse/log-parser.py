@@ -11,91 +11,136 @@ This program reads a raw log of a test run and extracts test reports in xunit
 format.
 '''
 
+import io
+import os
 import sys
-import xunitgen
-import tempfile
-import shutil
+import time
+import errno
+import signal
 
 from os       import path
 from enum     import Enum
-from argparse import ArgumentParser
+from array    import array
+from argparse import ArgumentParser, ArgumentTypeError
 
 class CaseCode (Enum):
     PASS = 1
     FAIL = 2
     NOTRUN = 3
 
-class CaseResult (object):
-    def __init__(self, code=CaseCode.NOTRUN, msg=''):
-        self.code = code
-        self.msg  = msg
-
 result_convert = { "PASS":  CaseCode.PASS, "FAIL": CaseCode.FAIL }
 
+# Plain values are used internally, Enum attribute lookups are slow.
+_case_codes = dict ((c.value, c) for c in CaseCode)
+_result_values = dict ((k, v.value) for k, v in result_convert.iteritems())
+_PASS = CaseCode.PASS.value
+_FAIL = CaseCode.FAIL.value
+_NOTRUN = CaseCode.NOTRUN.value
+
 OPEN_MSG = '||--> LOG_PARSER_MSG: '
 CLOSE_MSG = ' <--||'
 
 class TestResults (object):
+    '''
+    Results of a test suite. Suites can have tens of thousands of cases, so
+    they are stored on arrays indexed by declaration position instead of on an
+    object per case. The cases that didn't run are kept on a doubly linked
+    list, so neither updating a case nor listing the ones that didn't run
+    needs to go through all of them.
+    '''
+    __slots__ = (
+        'names', 'index', 'codes', 'msgs', 'order', 'counts',
+        '_notrun_next', '_notrun_prev', '_notrun_first', '_notrun_last',
+        'measurements', 'measurements_x_axis', 'message_count')
+
     def __init__(self):
-        self.success_count = 0
-        self.failure_count = 0
-        self.notrun_count = 0
-        self.total_count = 0
-        self.test_order = []
-        self.cases = {}
+        self.names = []            # Interned case names in declaration order.
+        self.index = {}            # Case name to position on "names".
+        self.codes = array ('B')   # CaseCode values.
+        self.msgs = {}             # Position to result message, if any.
+        self.order = array ('l')   # Positions of the cases that ran.
+        self.counts = [0] * (max (_case_codes) + 1)
+        self._notrun_next = array ('l')
+        self._notrun_prev = array ('l')
+        self._notrun_first = -1
+        self._notrun_last = -1
         self.measurements = {}
         self.measurements_x_axis = "0"
-
-class JenkinsLogParseException (Exception):
-    pass
-
-def parse_results (jenkins_output_log_str):
-    on_multiline_msg = False
-    msgs = []
-
-    #Filter entries
-    for line in jenkins_output_log_str.splitlines():
-        if not on_multiline_msg:
-            if line.startswith (OPEN_MSG):
-                line = line[len (OPEN_MSG):]
-
-                if line.endswith (CLOSE_MSG):
-                    line = line[:-len (CLOSE_MSG)]
-                else:
-                    on_multiline_msg = True
-
-                msgs.append (line)
+        self.message_count = 0
+
+    @property
+    def total_count (self):
+        return len (self.names)
+
+    @property
+    def success_count (self):
+        return self.counts[_PASS]
+
+    @property
+    def failure_count (self):
+        return self.counts[_FAIL]
+
+    @property
+    def notrun_count (self):
+        return self.counts[_NOTRUN]
+
+    def iter_run (self):
+        '''Yields (name, CaseCode, message) for the cases that ran, in the
+        order they first did.'''
+        for pos in self.order:
+            yield self.names[pos], _case_codes[self.codes[pos]], self.msgs.get (pos, '')
+
+    def iter_notrun (self):
+        '''Yields the names of the cases that didn't run in declaration order'''
+        pos = self._notrun_first
+        while pos >= 0:
+            yield self.names[pos]
+            pos = self._notrun_next[pos]
+
+    def add_message (self, msg):
+        '''Updates the results with the contents of a parser message'''
+        self.message_count += 1
+        if self.message_count == 1:
+            self._add_case_enum (msg)
         else:
-            if line.endswith (CLOSE_MSG):
-                on_multiline_msg = False
-                line = line[:-len (CLOSE_MSG)]
-
-            msgs[-1] = msgs[-1] + line
-
-    if on_multiline_msg and len (msgs) > 0:
-        raise JenkinsLogParseException ('End of file reached without finding closing for message: \"{}\".'.format(msgs[-1]))
-
-    if len (msgs) == 0:
-        raise JenkinsLogParseException ('This log contains no messages.')
-
-    if len (msgs) == 2:
-        raise JenkinsLogParseException ('Each log has to contain a case enumeration and a build number.')
-
-    res = TestResults()
+            self._add_case_or_sample (msg)
 
-    testcases = msgs[0].split()
-    if len (testcases) == 0 or testcases[0] != 'CASE_ENUM':
-        raise JenkinsLogParseException(
-            'The first expected message tag in the log should be CASE_ENUM. Found: "{}"'
-                .format (testcases[0]))
-
-    testcases        = testcases[1:]
-    res.total_count  = len(testcases)
-    res.notrun_count = res.total_count
-    for testcase in testcases:
-        res.cases[testcase] = CaseResult (CaseCode.NOTRUN)
+    def _add_case_enum (self, msg):
+        testcases = msg.split()
+        if len (testcases) == 0 or testcases[0] != 'CASE_ENUM':
+            raise JenkinsLogParseException(
+                'The first expected message tag in the log should be CASE_ENUM. Found: "{}"'
+                    .format (testcases[0]))
+
+        for testcase in testcases[1:]:
+            if testcase not in self.index:
+                testcase = intern (testcase)
+                self.index[testcase] = len (self.names)
+                self.names.append (testcase)
+
+        count = len (self.names)
+        self.codes = array ('B', [_NOTRUN]) * count
+        self.counts[_NOTRUN] = count
+        self._notrun_next = array ('l', xrange (1, count + 1))
+        self._notrun_prev = array ('l', xrange (-1, count - 1))
+        if count > 0:
+            self._notrun_next[-1] = -1
+            self._notrun_first = 0
+            self._notrun_last = count - 1
+
+    def _unlink_notrun (self, pos):
+        nextpos = self._notrun_next[pos]
+        prevpos = self._notrun_prev[pos]
+        if prevpos < 0:
+            self._notrun_first = nextpos
+        else:
+            self._notrun_next[prevpos] = nextpos
+        if nextpos < 0:
+            self._notrun_last = prevpos
+        else:
+            self._notrun_prev[nextpos] = prevpos
 
-    for msg in msgs[1:]:
+    def _add_case_or_sample (self, msg):
         tokens = msg.split (' ', 3)
 
         if tokens[0] == 'SAMPLE':
@@ -103,12 +148,12 @@ def parse_results (jenkins_output_log_str):
                 raise JenkinsLogParseException(
                     'Malformed SAMPLE message: "{}"'.format (msg))
             try:
-                res.measurements[tokens[1]] = float (tokens[2])
+                self.measurements[tokens[1]] = float (tokens[2])
             except ValueError:
                 raise JenkinsLogParseException(
                     'Invalid SAMPLE value, expected a float. Found: "{}"'
                         .format (tokens[2]))
-            continue
+            return
 
         elif tokens[0] != 'CASE':
             raise JenkinsLogParseException(
@@ -119,55 +164,233 @@ def parse_results (jenkins_output_log_str):
             raise JenkinsLogParseException(
                 'Malformed CASE message: "{}"'.format (msg))
 
-        previous_result = res.cases.get (tokens[1])
-        if previous_result is None:
+        pos = self.index.get (tokens[1])
+        if pos is None:
             raise JenkinsLogParseException(
                 'Test case was not previously declared: "{}"'
                     .format (tokens[1]))
 
         # Just PASS/FAIL for now
-        casecode = result_convert.get (tokens[2])
+        casecode = _result_values.get (tokens[2])
         if casecode is None:
             raise JenkinsLogParseException(
                 'Unknown type of result for test "{}": "{}"'
                     .format (tokens[1], tokens[2]))
 
-        if previous_result.code == CaseCode.NOTRUN:
-            res.test_order.append(tokens[1])
-            res.notrun_count -=1
-        elif previous_result.code == CaseCode.PASS:
-            #setting same test twice. WARN? ALLOWED?
-            res.success_count.code -=1
-        elif previous_result == CaseCode.FAIL:
-            #setting same test twice. WARN? ALLOWED?
-            res.failure_count -=1
+        # Setting the same test twice keeps its order and the last result.
+        # WARN? ALLOWED?
+        previous = self.codes[pos]
+        if previous == _NOTRUN:
+            self.order.append (pos)
+            self._unlink_notrun (pos)
 
-        resmsg = '' if len(tokens) != 4 else tokens[3]
-        res.cases[tokens[1]] = CaseResult (casecode, resmsg)
+        self.counts[previous] -= 1
+        self.counts[casecode] += 1
+        self.codes[pos] = casecode
 
-        if casecode == CaseCode.PASS:
-            res.success_count +=1
-        elif casecode == CaseCode.FAIL:
-            res.failure_count +=1
+        if len(tokens) == 4:
+            self.msgs[pos] = tokens[3]
+        else:
+            self.msgs.pop (pos, None)
+
+class JenkinsLogParseException (Exception):
+    pass
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+class _LogReader (object):
+    def __init__(self, logfile, blocksize, wait):
+        self.logfile = logfile
+        self.blocksize = blocksize
+        self.wait = wait
+        # A line break is prepended so a message at the very start of the log
+        # is detected as being at the start of a line.
+        self.buf = '\n'
+        self.eof = False
+
+    def consume (self, pos):
+        '''Drops the data before "pos" except the character preceding it
+        (to tell if "pos" is at the start of a line). Returns the new
+        position.'''
+        if pos > 1:
+            self.buf = self.buf[pos - 1:]
+        return 1
+
+    def fill (self):
+        while not self.eof:
+            data = self.logfile.read (self.blocksize)
+            if data:
+                self.buf += data
+                return True
+            if self.wait is None or not self.wait():
+                self.eof = True
+        return False
+
+def iter_messages (logfile, blocksize=READ_BLOCK_SIZE, wait=None):
+    '''
+    Yields the contents of the parser messages on a log file object as they are
+    read. The log is read in blocks and the text between messages is skipped
+    by searching for OPEN_MSG, so the memory used doesn't depend on the size
+    of the log. Lines are split as "str.splitlines" does.
+
+    When "wait" is given it is called each time the end of the file is
+    reached. It returns True to try reading again (to follow a log that is
+    still being written) or False when the log is complete.
+    '''
+    r = _LogReader (logfile, blocksize, wait)
+    pos = 1
+
+    while True:
+        start = r.buf.find (OPEN_MSG, pos)
+        if start < 0:
+            # Keep what could be the start of a partial marker and the
+            # character preceding it.
+            keep = max (pos, len (r.buf) - len (OPEN_MSG) + 1) - 1
+            r.buf = r.buf[keep:]
+            pos = 1
+            if not r.fill():
+                return
+            continue
+
+        if r.buf[start - 1] not in '\r\n':
+            pos = start + 1
+            continue
+
+        parts = []
+        pos = start + len (OPEN_MSG)
+        while True:
+            buf = r.buf
+            lf = buf.find ('\n', pos)
+            cr = buf.find ('\r', pos, len (buf) if lf < 0 else lf)
+            if cr >= 0 and (cr + 1 < len (buf) or r.eof):
+                end = cr
+                nextpos = cr + 2 if buf[cr + 1:cr + 2] == '\n' else cr + 1
+            elif cr < 0 and lf >= 0:
+                end = lf
+                nextpos = lf + 1
+            elif not r.eof:
+                # Don't carry what was already consumed across refills.
+                pos = r.consume (pos)
+                r.fill()
+                continue
+            else:
+                end = nextpos = len (buf)
+
+            line = buf[pos:end]
+            pos = nextpos
+            if line.endswith (CLOSE_MSG):
+                parts.append (line[:-len (CLOSE_MSG)])
+                break
+            parts.append (line)
+
+            if pos == len (r.buf):
+                pos = r.consume (pos)
+                if not r.fill():
+                    raise JenkinsLogParseException (
+                        'End of file reached without finding closing for message: \"{}\".'
+                            .format (''.join (parts)))
+
+        yield ''.join (parts)
+
+class LogFollower (object):
+    '''
+    "wait" callable for "iter_messages" to follow a log that is still being
+    written, as "tail -f" does. "on_poll" is called every time the end of the
+    log is reached and "is_done" tells when no more data will be written. A
+    last read is done after that or after "stop" is called, so everything on
+    the log is parsed.
+    '''
+    def __init__(self, poll_interval, on_poll=None, is_done=None):
+        self.poll_interval = poll_interval
+        self.on_poll = on_poll
+        self.is_done = is_done
+        self.stopping = False
+        self.stopped = False
+
+    def stop (self):
+        self.stopping = True
+
+    def __call__(self):
+        if self.stopped:
+            return False
+        if self.on_poll is not None:
+            self.on_poll()
+        if not self.stopping and self.is_done is not None and self.is_done():
+            self.stopping = True
+        if self.stopping:
+            self.stopped = True
+            return True
+        time.sleep (self.poll_interval)
+        return True
+
+def pid_alive (pid):
+    try:
+        os.kill (pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class ProgressiveLogReader (object):
+    '''
+    File-like reader of the console log of a Jenkins build through its
+    "logText/progressiveText" endpoint. "read" returns an empty string when
+    there is no new text yet, "complete" is set once Jenkins reports that the
+    build has finished and all its log was read.
+    '''
+    def __init__(self, build_url):
+        self.url = build_url.rstrip ('/') + '/logText/progressiveText'
+        self.offset = 0
+        self.pending = ''
+        self.complete = False
+
+    def read (self, size):
+        if not self.pending and not self.complete:
+            import urllib2
+            rsp = urllib2.urlopen ('{}?start={}'.format (self.url, self.offset))
+            self.pending = rsp.read()
+            self.offset = int (rsp.info().getheader ('X-Text-Size', self.offset))
+            self.complete = rsp.info().getheader ('X-More-Data') is None
+        ret = self.pending[:size]
+        self.pending = self.pending[size:]
+        return ret
+
+def parse_results (logfile, wait=None, results=None):
+    '''
+    Parses the messages on a log file object to a "TestResults" instance. An
+    existing instance can be passed on "results", so it is kept up to date
+    while a log is followed (see "iter_messages" for "wait").
+    '''
+    res = TestResults() if results is None else results
+
+    for msg in iter_messages (logfile, wait=wait):
+        res.add_message (msg)
+
+    if res.message_count == 0:
+        raise JenkinsLogParseException ('This log contains no messages.')
+
+    if res.message_count == 2:
+        raise JenkinsLogParseException ('Each log has to contain a case enumeration and a build number.')
 
     return res
 
 def generate_xunit (results, suite_name):
+    # Only imported when needed, this script runs a few times per build.
+    import xunitgen
+    import tempfile
+    import shutil
+
     tmpdir = tempfile.mkdtemp()
     dst    = xunitgen.XunitDestination(tmpdir)
 
     with xunitgen.Recorder (dst, suite_name) as recorder:
-        for test in results.test_order:
+        for test, code, msg in results.iter_run():
             with recorder.step (test) as step:
-                result = results.cases[test]
-                if result.code == CaseCode.FAIL:
-                    step.error (result.msg)
+                if code == CaseCode.FAIL:
+                    step.error (msg)
 
-        if results.notrun_count > 0:
-            for test, result in results.cases.iteritems():
-                if result.code == CaseCode.NOTRUN:
-                    with recorder.step (test) as step:
-                        step.error ('This test did never run.')
+        for test in results.iter_notrun():
+            with recorder.step (test) as step:
+                step.error ('This test did never run.')
 
     with open (path.join (tmpdir, suite_name + '.xml'), 'r') as xmlfile:
         retxml = xmlfile.read()
@@ -176,23 +399,20 @@ def generate_xunit (results, suite_name):
     return retxml
 
 def generate_human (results, suite_name):
-    res = '[SUITE   ] {}\n'.format(suite_name)
-
-    for test in results.test_order:
-        result = results.cases[test]
-        if result.code == CaseCode.FAIL:
-            res += ' [FAILED ] {}\n'.format (test)
-            if result.msg != '':
-                res += '           {}\n'.format (result.msg)
+    lines = ['[SUITE   ] {}\n'.format(suite_name)]
+
+    for test, code, msg in results.iter_run():
+        if code == CaseCode.FAIL:
+            lines.append (' [FAILED ] {}\n'.format (test))
+            if msg != '':
+                lines.append ('           {}\n'.format (msg))
         else:
-            res += ' [SUCCESS] {}\n'.format (test)
+            lines.append (' [SUCCESS] {}\n'.format (test))
 
-    if results.notrun_count > 0:
-        for test, result in results.cases.iteritems():
-            if result.code == CaseCode.NOTRUN:
-                res += ' [NOT RUN] {}\n'.format (test)
+    for test in results.iter_notrun():
+        lines.append (' [NOT RUN] {}\n'.format (test))
 
-    return res
+    return ''.join (lines)
 
 def generate_stats (results, suite_name):
     res = 'Total: {}, succeeded: {}, failed: {}, not run: {}'.format(
@@ -215,6 +435,52 @@ format_converters = {
     'meas'  : generate_measurements,
 }
 
+def output_arg (value):
+    '''Parses an output argument: a format, optionally followed by a colon
+    and the file to write it to (stdout otherwise).'''
+    fmt, _, dst = value.partition (':')
+    if fmt not in format_converters:
+        raise ArgumentTypeError(
+            'invalid format: "{}" (choose from {})'
+                .format (fmt, ', '.join (sorted (format_converters.keys()))))
+    return fmt, dst or None
+
+def write_output (results, suite_name, fmt, dst):
+    ret = format_converters[fmt] (results, suite_name)
+    if dst is None:
+        print ret
+    else:
+        # Replaced atomically, a followed log can rewrite it at any time.
+        tmp = dst + '.tmp'
+        with open (tmp, 'w') as f:
+            f.write (ret + '\n')
+        os.rename (tmp, dst)
+
+class SnapshotWriter (object):
+    '''
+    "on_poll" callback for "LogFollower" that rewrites the file outputs with the
+    partial results, at most every "interval" seconds and only if new messages
+    were parsed.
+    '''
+    def __init__(self, results, suite_name, outputs, interval):
+        self.results = results
+        self.suite_name = suite_name
+        self.outputs = [(fmt, dst) for fmt, dst in outputs if dst is not None]
+        self.interval = interval
+        self.written_count = 0
+        self.written_time = 0
+
+    def __call__(self):
+        now = time.time()
+        if self.results.message_count == self.written_count:
+            return
+        if now - self.written_time < self.interval:
+            return
+        for fmt, dst in self.outputs:
+            write_output (self.results, self.suite_name, fmt, dst)
+        self.written_count = self.results.message_count
+        self.written_time = now
+
 def main():
     parser = ArgumentParser(
         description='Parses test results from the Jenkins output logs of a hottest run to standard formats')
@@ -236,24 +502,98 @@ def main():
     parser.add_argument(
         '-t', '--output-type-format',
         required=False,
-        action='store',
-        default='human',
-        choices=format_converters.keys(),
-        help='Format type to output. One of {}'
+        action='append',
+        default=[],
+        type=output_arg,
+        help='Format type to output. One of {}. Can be suffixed by ":<file>" to write it to a file instead of stdout. This flag can be repeated, the log is parsed once for all of them. Defaults to "human"'
             .format (' '.join (format_converters.keys())))
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--check-all-passed',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Exit with an error code unless all the test cases ran and passed.')
+
+    parser.add_argument(
+        '--follow',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Keep reading the log file as it grows, like "tail -f" does. The outputs written to files are updated periodically with the partial results. It runs until SIGINT/SIGTERM is received or the process given on "--follow-pid" exits, then the final outputs are written.')
+
+    parser.add_argument(
+        '--follow-pid',
+        action='store',
+        required=False,
+        default=None,
+        type=int,
+        help='When following, stop once this process (e.g. the one writing the log) exits.')
+
+    parser.add_argument(
+        '--follow-url',
+        action='store',
+        required=False,
+        default=None,
+        help='Follow the console log of a running Jenkins build instead of a file, e.g. "http://jenkins/job/myjob/42". It stops when the build finishes.')
+
+    parser.add_argument(
+        '--poll-interval',
+        action='store',
+        required=False,
+        default=1.0,
+        type=float,
+        help='When following, seconds to wait after reaching the end of the log before reading it again.')
 
-    if args.log_file is None:
-        logdata = sys.stdin.read()
+    parser.add_argument(
+        '--snapshot-interval',
+        action='store',
+        required=False,
+        default=10.0,
+        type=float,
+        help='When following, minimum seconds between updates of the outputs written to files.')
+
+    args = parser.parse_args()
+    outputs = args.output_type_format or [('human', None)]
+
+    if args.follow_url is not None:
+        logfile = ProgressiveLogReader (args.follow_url)
+    elif args.log_file is None:
+        if args.follow:
+            parser.error ('--follow requires --log-file')
+        logfile = sys.stdin
     else:
-        with open (args.log_file, 'r') as logfile:
-            logdata = logfile.read()
+        # "io" doesn't keep the end of file condition, so a log being written
+        # can be read again.
+        logfile = io.open (args.log_file, 'rb')
+
+    res = TestResults()
+    wait = None
+
+    if args.follow or args.follow_url is not None:
+        if args.follow_url is not None:
+            is_done = lambda: logfile.complete
+        elif args.follow_pid is not None:
+            is_done = lambda: not pid_alive (args.follow_pid)
+        else:
+            is_done = None
+
+        wait = LogFollower(
+            args.poll_interval,
+            SnapshotWriter (res, args.suite_name, outputs, args.snapshot_interval),
+            is_done)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal (signum, lambda signum, frame: wait.stop())
+
+    parse_results (logfile, wait, res)
 
-    res = parse_results (logdata)
+    for fmt, dst in outputs:
+        write_output (res, args.suite_name, fmt, dst)
 
-    ret = format_converters[args.output_type_format] (res, args.suite_name)
-    print ret
+    if args.check_all_passed:
+        if res.failure_count != 0 or res.notrun_count != 0:
+            sys.exit (1)
 
 if __name__ == '__main__':
     main()
@@ -9,16 +9,25 @@
 '''
 This program attaches to the console early in U-Boot to be able to print the
 Kernel boot log on stdout. It stops when either a string is matched (e.g.
-"login: ") or times out.
+"login: "), a failed boot is detected (a kernel panic, a reset or a custom
+regular expression) or it times out.
+
+When the HOTTEST_UBOOT_CONTROLLER environment variable is set the request is
+forwarded to that "uboot_controller.py" service instead, if it is running.
 '''
+import os
 import sys
 import logging
 import time
-import serial
 from argparse   import ArgumentParser
 from contextlib import closing
 
-from hush_shell import HushShell
+from hush_shell       import HushShell
+from uboot_controller import CONTROLLER_SOCKET_ENV, forward_to_controller, \
+    open_serial, login, BootMatcher, compile_fail_match
+
+# Seconds between flushes of the console output while it keeps coming.
+FLUSH_INTERVAL = 0.2
 
 def parse_and_validate_args():
     ''' Parse and sanity check command line arguments.'''
@@ -71,6 +80,20 @@ def parse_and_validate_args():
         default=20,
         type=int,
         help='Returns an error code after this time has passed without being able to access the uboot shell')
+    parser.add_argument(
+        '-f',
+        '--fail-match',
+        action='append',
+        type=compile_fail_match,
+        required=False,
+        default=[],
+        help='Regular expression that makes the boot fail as soon as it is seen on the console. Can be repeated.')
+    parser.add_argument(
+        '--no-failure-detection',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Don\'t fail the boot early on kernel panics or when the bootloader starts again after the kernel did.')
     args = parser.parse_args()
     return args
 
@@ -78,18 +101,15 @@ def main():
     ''' Main function '''
     args  = parse_and_validate_args()
 
-    ser          = serial.Serial()
-    ser.port     = args.serial_dev
-    ser.parity   = serial.PARITY_NONE
-    ser.bytesize = serial.EIGHTBITS
-    ser.stopbits = serial.STOPBITS_ONE
-    ser.timeout  = 0.5
-    ser.xonxoff  = 0
-    ser.rtscts   = 0
-    ser.dsrdtr   = 0
-    ser.baudrate = args.baudrate
+    socket_path = os.environ.get (CONTROLLER_SOCKET_ENV)
+    if socket_path:
+        request = vars (args)
+        request['fail_match'] = [regex.pattern for regex in args.fail_match]
+        status = forward_to_controller (socket_path, request)
+        if status is not None:
+            return status
 
-    ser.open()
+    ser = open_serial (args.serial_dev, args.baudrate)
     with (closing (ser)):
         shell = HushShell(ser, logging.getLogger(__name__))
         print('waiting for U-boot shell')
@@ -98,21 +118,34 @@ def main():
         ser.write('\n') # Terminal cleanup
         shell.command_raw(args.boot_cmd)
 
-        start   = time.time()
-        cmpbuff = ''
-        while time.time() - start < args.timeout:
-            data = ser.read()
-            sys.stdout.write(data)
-            sys.stdout.flush()
-            cmpbuff += data
-            if args.login_match in cmpbuff:
-                sys.stdout.write('\n')
-                ser.write(args.user + '\n')
-                ser.flushInput()
-                ser.write('\n')
-                ser.flushInput()
-                return 0
-            cmpbuff = cmpbuff[-len(args.login_match):]
+        matcher = BootMatcher(
+            args.login_match, args.fail_match, not args.no_failure_detection)
+        start      = time.time()
+        last_flush = start
+        # Output that the shell already read after the command echo.
+        data = shell.pop_received()
+        while True:
+            if data:
+                sys.stdout.write(data)
+                result = matcher.feed(data)
+                if result is not None:
+                    success, description = result
+                    if success:
+                        sys.stdout.write('\n')
+                        login(ser, args.user)
+                        return 0
+                    print('\nBoot failed: {}'.format(description))
+                    return 1
+
+            now = time.time()
+            if not data or now - last_flush >= FLUSH_INTERVAL:
+                sys.stdout.flush()
+                last_flush = now
+            if now - start >= args.timeout:
+                break
+            # Everything available at once, or wait (up to the port timeout)
+            # for the next byte.
+            data = ser.read(max(ser.in_waiting, 1))
 
         print('\nTimed out while trying to match: \"{}\"'.format(
             args.login_match))
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Service that boots boards from U-Boot and logs in to their Linux console, for
+many serial ports at once from a single process. Each board's console is
+streamed to its own log file and back to the client that requested the boot.
+
+"uboot-boot-and-login.py" forwards its requests to this service when the
+HOTTEST_UBOOT_CONTROLLER environment variable points to its socket.
+'''
+import os
+import re
+import sys
+import errno
+import json
+import time
+import socket
+import signal
+import logging
+import traceback
+import serial
+from os         import path
+from argparse   import ArgumentParser, ArgumentTypeError
+from contextlib import closing
+
+from hush_shell import HushShell, HushShellDelays, HushLoop, Return, \
+    sleep_async
+
+CONTROLLER_SOCKET_ENV = 'HOTTEST_UBOOT_CONTROLLER'
+# Seconds for a client to send its request and to accept the last reply before
+# it is considered gone.
+CLIENT_TIMEOUT = 10
+# Replies queued for a client that doesn't keep up (bytes) before it is
+# considered gone. Client sockets never block the loop.
+CLIENT_MAX_QUEUED = 1024 * 1024
+
+class ControllerError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+def open_serial(serial_dev, baudrate):
+    ser          = serial.Serial()
+    ser.port     = serial_dev
+    ser.parity   = serial.PARITY_NONE
+    ser.bytesize = serial.EIGHTBITS
+    ser.stopbits = serial.STOPBITS_ONE
+    ser.timeout  = 0.5
+    ser.xonxoff  = 0
+    ser.rtscts   = 0
+    ser.dsrdtr   = 0
+    ser.baudrate = baudrate
+    ser.open()
+    return ser
+
+def login(ser, user):
+    ser.write (user + '\n')
+    ser.flushInput()
+    ser.write ('\n')
+    ser.flushInput()
+
+def compile_fail_match(regex):
+    '''argparse type of the "--fail-match" regular expressions.'''
+    try:
+        return re.compile (regex)
+    except re.error as e:
+        raise ArgumentTypeError(
+            'invalid regular expression "{}": {}'.format (regex, e))
+
+class BootMatcher(object):
+    '''Watches the console of a booting board for the login prompt and for
+    signs of a failed boot: a kernel panic, the bootloader starting again
+    after the kernel did (a reset) or any of the "fail_matches" regular
+    expressions (strings or compiled). Each call searches the new data plus
+    a rolling window of the previous one, so matches split between reads are
+    found without rescanning the whole output.
+
+    The built-in targets are searched with a single regular expression. The
+    "fail_matches" are searched on their own: spliced into that expression
+    their group names and numbers would clash with the built-in ones.'''
+    KERNEL_START = r'Starting kernel'
+    KERNEL_PANIC = r'Kernel panic - not syncing'
+    BOOTLOADER_START = r'U-Boot (?:SPL )?\d{4}\.\d{2}'
+
+    def __init__(
+            self, login_match, fail_matches=[], detect_failures=True,
+            window=4096):
+        targets = [('login', re.escape (login_match))]
+        if detect_failures:
+            targets += [
+                ('kernel', self.KERNEL_START),
+                ('panic', self.KERNEL_PANIC),
+                ('bootloader', self.BOOTLOADER_START)]
+        self.regex = re.compile ('|'.join (
+            '(?P<{}>{})'.format (name, regex) for name, regex in targets))
+        self.fail_matches = [re.compile (regex) for regex in fail_matches]
+        self.window = window
+        self.tail = ''
+        self.kernel_started = False
+
+    @staticmethod
+    def _new_matches(regex, buf, seen):
+        '''Matches of "regex" on "buf" not found by a previous call, the ones
+        ending past the first "seen" characters.'''
+        return [m for m in regex.finditer (buf) if m.end() > seen]
+
+    def feed(self, data):
+        '''Returns None while the boot goes on, otherwise a (success,
+        description) tuple.'''
+        buf = self.tail + data
+        seen = len (self.tail)
+        events = [
+            (m.start(), m.lastgroup, None)
+            for m in self._new_matches (self.regex, buf, seen)]
+        for regex in self.fail_matches:
+            matches = self._new_matches (regex, buf, seen)
+            if matches:
+                events.append ((matches[0].start(), 'fail', regex))
+
+        for _, name, regex in sorted (events, key=lambda event: event[0]):
+            if name == 'login':
+                return True, 'login prompt found'
+            elif name == 'kernel':
+                self.kernel_started = True
+            elif name == 'panic':
+                return False, 'kernel panic'
+            elif name == 'bootloader':
+                if self.kernel_started:
+                    return False, 'the board was reset after starting the kernel'
+            else:
+                return False, 'failure match: "{}"'.format (regex.pattern)
+        self.tail = buf[-self.window:]
+        return None
+
+def forward_to_controller(socket_path, request):
+    '''Runs a boot request (the arguments of "uboot-boot-and-login.py") on
+    the controller, writing the console output to stdout as it arrives.
+    Returns the exit status or None if the controller isn't running.'''
+    conn = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect (socket_path)
+    except socket.error:
+        conn.close()
+        return None
+
+    with closing (conn):
+        conn.sendall (json.dumps (request) + '\n')
+        pending = ''
+        while True:
+            data = conn.recv (65536)
+            if not data:
+                sys.stderr.write ('uboot controller: connection lost\n')
+                return 1
+            pending += data
+            lines = pending.split ('\n')
+            pending = lines.pop()
+            for line in lines:
+                reply = json.loads (line)
+                if 'console' in reply:
+                    sys.stdout.write (reply['console'].encode ('latin-1'))
+                    sys.stdout.flush()
+                    continue
+                if reply.get ('error'):
+                    sys.stderr.write (
+                        'uboot controller: {}\n'.format (reply['error']))
+                return reply['status']
+
+class Controller(object):
+    '''Runs boot requests concurrently on a single HushLoop. The listening
+    socket, the clients and the serial ports are all waited on by the same
+    "select".'''
+    def __init__(self, log_dir):
+        self.loop = HushLoop()
+        self.log_dir = log_dir
+        self.busy_ports = set()
+        # Delays learned by the shell of each port (see "HushShellDelays"),
+        # kept for its next requests.
+        self.delays = {}
+        self.log = logging.getLogger ('uboot-controller')
+
+    def serve(self, sock):
+        sock.setblocking (False)
+        self.loop.spawn (self._accept_async (sock))
+        self.loop.run()
+
+    def _accept_async(self, sock):
+        while True:
+            yield (sock, None)
+            try:
+                conn, _ = sock.accept()
+            except socket.error:
+                continue
+            conn.setblocking (False)
+            self.loop.spawn (self._client_async (conn))
+
+    def _read_request_async(self, conn):
+        deadline = time.time() + CLIENT_TIMEOUT
+        data = ''
+        while '\n' not in data:
+            if time.time() >= deadline:
+                raise ControllerError ('timeout reading the request')
+            yield (conn, deadline)
+            try:
+                block = conn.recv (65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            if not block:
+                raise ControllerError ('incomplete request')
+            data += block
+        request = json.loads (data.split ('\n', 1)[0])
+        # Serial writes take bytes.
+        raise Return (dict (
+            (k, v.encode ('utf-8') if isinstance (v, unicode) else v)
+            for k, v in request.items()))
+
+    def _client_async(self, conn):
+        client = _Client (conn)
+        try:
+            request = yield self._read_request_async (conn)
+            status = yield self._boot_async (request, client.send_console)
+            client.send ({ 'status' : status })
+        except Exception as e:
+            self.log.error ('request failed: %s', e)
+            self.log.debug (traceback.format_exc())
+            client.send ({ 'status' : 1, 'error' : str (e) })
+        try:
+            yield client.drain_async (time.time() + CLIENT_TIMEOUT)
+        finally:
+            conn.close()
+
+    def _boot_async(self, request, emit):
+        '''Coroutine version of "uboot-boot-and-login.py" for a request with
+        its arguments. Returns its exit status.'''
+        port = request['serial_dev']
+        if port in self.busy_ports:
+            raise ControllerError ('port already in use: {}'.format (port))
+
+        try:
+            matcher = BootMatcher(
+                request['login_match'],
+                request.get ('fail_match') or [],
+                not request.get ('no_failure_detection'))
+        except re.error as e:
+            raise ControllerError(
+                'invalid "fail_match" regular expression: {}'.format (e))
+
+        self.busy_ports.add (port)
+        try:
+            logfile = path.join (self.log_dir, path.basename (port) + '.log')
+            with closing (open_serial (port, request['baudrate'])) as ser, \
+                    open (logfile, 'ab') as log:
+                def console(data):
+                    log.write (data)
+                    log.flush()
+                    emit (data)
+
+                self.log.info ('%s: booting', port)
+                console ('\n*** {}: boot requested\n'.format (time.ctime()))
+                status = yield self._boot_and_login_async(
+                    ser, request, matcher, console)
+                self.log.info ('%s: done, status: %d', port, status)
+                raise Return (status)
+        finally:
+            self.busy_ports.discard (port)
+
+    def _boot_and_login_async(self, ser, request, matcher, console):
+        port = request['serial_dev']
+        shell = HushShell(
+            ser,
+            logging.getLogger (port),
+            self.delays.setdefault (port, HushShellDelays()))
+        console ('waiting for U-boot shell\n')
+        yield shell.connect_async (request['uboot_connect_timeout'])
+        console ('running boot command: "{}"\n'.format (request['boot_cmd']))
+        ser.write ('\n') # Terminal cleanup
+        yield shell.command_raw_async (request['boot_cmd'])
+
+        deadline = time.time() + request['timeout']
+        while True:
+            data = shell.pop_received()
+            if data:
+                console (data)
+                result = matcher.feed (data)
+                if result is not None:
+                    success, description = result
+                    if success:
+                        console ('\n')
+                        login (ser, request['user'])
+                        raise Return (0)
+                    console ('\nBoot failed: {}\n'.format (description))
+                    raise Return (1)
+
+            if time.time() >= deadline:
+                console ('\nTimed out while trying to match: \"{}\"\n'
+                    .format (request['login_match']))
+                raise Return (1)
+            yield (shell, deadline)
+
+class _Client(object):
+    '''Replies to a client on a non-blocking socket. What the socket doesn't
+    take right away is queued, up to CLIENT_MAX_QUEUED bytes. Once the client
+    is gone (or too slow) the boot goes on, only the log file gets the
+    console output.'''
+    # Interval (seconds) to retry sending the queued replies when draining.
+    DRAIN_POLL_INTERVAL = 0.05
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.queued = bytearray()
+        self.gone = False
+
+    def _flush(self):
+        while self.queued and not self.gone:
+            try:
+                sent = self.conn.send (self.queued)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.gone = True
+                break
+            del self.queued[:sent]
+        if len (self.queued) > CLIENT_MAX_QUEUED:
+            logging.getLogger ('uboot-controller').warning(
+                'client not reading its replies, dropping it')
+            self.gone = True
+        if self.gone:
+            del self.queued[:]
+
+    def send(self, reply):
+        if self.gone:
+            return
+        self.queued += json.dumps (reply) + '\n'
+        self._flush()
+
+    def drain_async(self, deadline):
+        '''Coroutine that sends the queued replies until "deadline".'''
+        while self.queued and not self.gone and time.time() < deadline:
+            yield sleep_async(
+                min (self.DRAIN_POLL_INTERVAL, deadline - time.time()))
+            self._flush()
+
+    def send_console(self, data):
+        self.send ({ 'console' : data.decode ('latin-1') })
+
+def parse_and_validate_args():
+    parser = ArgumentParser(
+        description='Serves boot and login requests for many U-Boot boards from a single process. Set {} to the socket path on the jobs for "uboot-boot-and-login.py" to use it.'
+            .format (CONTROLLER_SOCKET_ENV))
+    parser.add_argument(
+        '-s',
+        '--socket',
+        action='store',
+        required=False,
+        default=os.environ.get (CONTROLLER_SOCKET_ENV),
+        help='Unix socket to listen on. Defaults to ${}.'
+            .format (CONTROLLER_SOCKET_ENV))
+    parser.add_argument(
+        '-l',
+        '--log-dir',
+        action='store',
+        required=False,
+        default='.',
+        help='Directory for the console logs, one "<serial device name>.log" file per board.')
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        required=False,
+        default=False,
+        help='Log the shell interactions.')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error ('no socket path, pass "--socket" or set {}'
+            .format (CONTROLLER_SOCKET_ENV))
+    return args
+
+def main():
+    ''' Main function '''
+    args = parse_and_validate_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s %(name)s: %(message)s')
+
+    if path.exists (args.socket):
+        os.remove (args.socket) # Stale socket of a previous run
+
+    sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask (0o077) # Only the owner can connect
+    try:
+        sock.bind (args.socket)
+    finally:
+        os.umask (umask)
+    sock.listen (64)
+    # Exit through "finally" to remove the socket file.
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (0))
+    print ('uboot controller: serving on: {}'.format (args.socket))
+    sys.stdout.flush()
+
+    try:
+        Controller (args.log_dir).serve (sock)
+    finally:
+        sock.close()
+        os.remove (args.socket)
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit (main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Fake U-Boot hush shell on a pseudo terminal, for testing the scripts that talk
+to boards over a serial port without a board. Prints the path of the terminal
+to connect to on stdout and serves it until killed.
+
+Supported commands: "echo", "setenv", "printenv", "true", "false",
+"slow <seconds>" and "boot". Statements can be chained with ";", "&&" and
+"||". "boot" prints some kernel output ("chatter" lines, 50 by default)
+followed by the "bootend" variable ("buildroot login: " by default) and stops
+echoing input, like a booted board.
+'''
+import os
+import pty
+import re
+import sys
+import time
+import tty
+import select
+from argparse import ArgumentParser
+
+class FakeUboot(object):
+    def __init__(self, fifo=0, echo_delay=0):
+        self.fifo = fifo
+        self.echo_delay = echo_delay
+        self.env = {}
+        self.rc = 0
+        self.out = ''
+        self.booted = False
+
+    def run_simple(self, cmd):
+        args = cmd.split()
+        if not args:
+            return self.rc
+        name = args[0]
+        if name == 'echo':
+            self.out += ' '.join(
+                a.replace ('$?', str (self.rc)) for a in args[1:]) + '\r\n'
+            return 0
+        if name == 'setenv':
+            self.env[args[1]] = ' '.join (args[2:])
+            return 0
+        if name == 'printenv':
+            self.out += '{}={}\r\n'.format (args[1], self.env.get (args[1], ''))
+            return 0 if args[1] in self.env else 1
+        if name == 'true':
+            return 0
+        if name == 'false':
+            return 1
+        if name == 'slow':
+            time.sleep (float (args[1]))
+            return 0
+        if name == 'boot':
+            self.out += 'Starting kernel ...\r\n'
+            self.out += '[    0.000000] Linux version 4.14\r\n'
+            self.out += ''.join(
+                '[    {}.000000] boot chatter line {}\r\n'.format (i, i)
+                for i in range (int (self.env.get ('chatter', '50'))))
+            self.out += self.env.get ('bootend', 'buildroot login: ')
+            self.booted = True
+            return 0
+        self.out += "Unknown command '{}' - try 'help'\r\n".format (name)
+        return 1
+
+    def run_line(self, line):
+        for statement in line.split (';'):
+            tokens = re.split (r'(&&|\|\|)', statement)
+            self.rc = self.run_simple (tokens[0])
+            for op, cmd in zip (tokens[1::2], tokens[2::2]):
+                if (op == '&&') == (self.rc == 0):
+                    self.rc = self.run_simple (cmd)
+
+    def serve(self, master):
+        line = ''
+        fresh = True # Next input starts a line
+        while True:
+            data = os.read (master, 4096).decode ('latin-1')
+            if self.fifo and len (data) > self.fifo:
+                data = data[:self.fifo] # Input FIFO overflow
+            if fresh and self.echo_delay and data.strip ('\r\n\x03'):
+                time.sleep (self.echo_delay)
+                if select.select ([master], [], [], 0)[0]:
+                    data += os.read (master, 4096).decode ('latin-1')
+                fresh = False
+
+            out = ''
+            for ch in data:
+                if self.booted:
+                    continue
+                if ch == '\x03':
+                    line = ''
+                    out += '<INTERRUPT>\r\n=> '
+                elif ch in '\r\n':
+                    out += '\r\n'
+                    if line.strip():
+                        self.out = ''
+                        self.run_line (line)
+                        out += self.out
+                    if not self.booted:
+                        out += '=> '
+                    line = ''
+                    fresh = True
+                else:
+                    line += ch
+                    out += ch
+            if out:
+                os.write (master, out.encode ('latin-1'))
+
+def main():
+    parser = ArgumentParser(
+        description='Serves a fake U-Boot shell on a pseudo terminal.')
+    parser.add_argument(
+        '--fifo',
+        action='store',
+        type=int,
+        required=False,
+        default=0,
+        help='Drops the input characters past this many per read, like an overflowing UART FIFO. 0 disables it.')
+    parser.add_argument(
+        '--echo-delay',
+        action='store',
+        type=float,
+        required=False,
+        default=0,
+        help='Seconds the first echo of each line is delayed.')
+    args = parser.parse_args()
+
+    master, slave = pty.openpty()
+    tty.setraw (slave)
+    print (os.ttyname (slave))
+    sys.stdout.flush()
+    FakeUboot (args.fifo, args.echo_delay).serve (master)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Tests the Jenkins XML generation of the gen tool ("gen.py"). Run with:
+
+    python scripts/test/test_gen.py
+'''
+import os
+import sys
+import unittest
+from os import path
+from xml.etree import ElementTree as ET
+from xml.dom.minidom import parseString as dom_parse_str
+
+TEST_DIR = path.dirname (path.realpath (__file__))
+sys.path.insert (0, path.join (path.dirname (TEST_DIR), 'cli'))
+import gen
+import sync
+from _cli_common import parse_json
+
+REPO_DIR = path.dirname (path.dirname (TEST_DIR))
+EXAMPLE_CFG = path.join (REPO_DIR, 'example-cfg')
+SYNC_FILE = path.join (EXAMPLE_CFG, 'sync', 'localsetup.json')
+CHUNK_DIRS = [path.join (REPO_DIR, 'chunks'), path.join (EXAMPLE_CFG, 'chunks')]
+PARAM_DIRS = [path.join (EXAMPLE_CFG, 'parametrization')]
+PIPELINE_DIRS = [path.join (EXAMPLE_CFG, 'pipelines')]
+ROOT_FOLDER = 'hottest-test'
+
+def minidom_to_str(root):
+    '''The serialization "xml_to_str" replaced.'''
+    return dom_parse_str(
+        ET.tostring (root, encoding='utf8', method='xml')).toprettyxml()
+
+class XmlToStrTest(unittest.TestCase):
+    def setUp(self):
+        self.syncjson = parse_json(
+            SYNC_FILE, sync.thisfile_dirname_join ('_schema_sync.json'))
+
+    def assertSameXml(self, name, xmlobj):
+        self.assertEqual(
+            gen.xml_to_str (xmlobj.root), minidom_to_str (xmlobj.root), name)
+
+    def test_example_tests(self):
+        arglist = sync.build_job_arglists(
+            self.syncjson, ROOT_FOLDER, CHUNK_DIRS, PARAM_DIRS)
+        self.assertTrue (arglist)
+        for args in arglist:
+            xmlobj = gen.JenkinsJobXml()
+            xmlobj.add_job (sync.gen_test_data (args))
+            self.assertSameXml (args.name, xmlobj)
+
+    def test_chunk_tests(self):
+        '''The test chunks shipped with the repository, on the example board.'''
+        for fname in sorted (os.listdir (path.join (REPO_DIR, 'chunks', 'test'))):
+            if not fname.endswith ('.json'):
+                continue
+            xmlobj = gen.JenkinsJobXml()
+            xmlobj.add_job(gen.TestData(
+                CHUNK_DIRS,
+                'board/dummyboard',
+                'test/' + path.splitext (fname)[0],
+                ['dummyboard'],
+                []))
+            self.assertSameXml (fname, xmlobj)
+
+    def test_example_nodes(self):
+        arglist = sync.build_node_arglists (self.syncjson, CHUNK_DIRS, PARAM_DIRS)
+        self.assertTrue (arglist)
+        for args in arglist:
+            xmlobj = gen.JenkinsNodeXml()
+            xmlobj.add_board (sync.gen_node_data (args))
+            self.assertSameXml (args.name, xmlobj)
+
+    def test_example_pipelines(self):
+        arglist = sync.build_pipeline_arglists(
+            self.syncjson, ROOT_FOLDER, PIPELINE_DIRS)
+        self.assertTrue (arglist)
+        for args in arglist:
+            pd = sync.gen_pipeline_data (args)
+            self.assertSameXml (args.name, gen.JenkinsPipelineXml (pd))
+
+    def test_special_characters(self):
+        root = ET.Element ('project')
+        root.text = 'a & b\r\n'
+        child = ET.SubElement (root, 'command', {'b' : '"<x>"', 'a' : "it's"})
+        child.text = 'echo "$1" > /dev/null\r\nexit 0\r'
+        child.tail = ' tail '
+        ET.SubElement (root, 'empty')
+        ET.SubElement (root, 'blank').text = ' '
+        self.assertEqual (gen.xml_to_str (root), minidom_to_str (root))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Tests the HushShell serial port handling ("hush_shell.py"). Run with:
+
+    python scripts/test/test_hush_shell.py
+'''
+import os
+import sys
+import time
+import fcntl
+import struct
+import logging
+import termios
+import unittest
+from os import path
+
+TEST_DIR = path.dirname (path.realpath (__file__))
+sys.path.insert (0, path.join (path.dirname (TEST_DIR), 'jenkins-home'))
+from hush_shell import HushShell, HushLoop, HushDisconnected
+
+class PipeSerial(object):
+    '''Serial port stand-in reading from a pipe. Once the writing end is
+    closed the pipe is readable without data waiting, as a serial adapter
+    that was unplugged.'''
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        self.timeout = 0.5
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        buf = fcntl.ioctl (self.rfd, termios.FIONREAD, struct.pack ('I', 0))
+        return struct.unpack ('I', buf)[0]
+
+    def fileno(self):
+        return self.rfd
+
+    def read(self, size=1):
+        self.reads += 1
+        return os.read (self.rfd, size)
+
+    def write(self, data):
+        return len (data)
+
+    def close(self):
+        os.close (self.rfd)
+        if self.wfd is not None:
+            os.close (self.wfd)
+
+    def hang_up(self):
+        os.close (self.wfd)
+        self.wfd = None
+
+class SerialInputTest(unittest.TestCase):
+    def setUp(self):
+        self.serial = PipeSerial()
+        self.shell = HushShell (self.serial, logging.getLogger ('test'))
+
+    def tearDown(self):
+        self.serial.close()
+
+    def readline(self, timeout):
+        return HushLoop().run_until_complete(
+            self.shell._readline_async (time.time() + timeout))
+
+    def test_readline(self):
+        os.write (self.serial.wfd, 'first\r\nsec')
+        self.assertEqual (self.readline (1), 'first\r\n')
+        self.assertEqual (self.readline (0.1), None)
+        os.write (self.serial.wfd, 'ond\n')
+        self.assertEqual (self.readline (1), 'second\n')
+
+    def test_hang_up(self):
+        '''A port readable without data fails right away instead of being
+        selected again until the deadline.'''
+        os.write (self.serial.wfd, 'partial')
+        self.serial.hang_up()
+        start = time.time()
+        with self.assertRaises (HushDisconnected):
+            self.readline (5)
+        self.assertLess (time.time() - start, 1)
+        self.assertLess (self.serial.reads, 10)
+
+if __name__ == '__main__':
+    unittest.main()
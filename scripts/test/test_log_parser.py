@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Tests the streaming of the log parser ("log-parser.py"). Run with:
+
+    python scripts/test/test_log_parser.py
+'''
+import io
+import imp
+import unittest
+from os import path
+
+TEST_DIR = path.dirname (path.realpath (__file__))
+LOG_PARSER = path.join(
+    path.dirname (TEST_DIR), 'jenkins-home', 'log-parse', 'log-parser.py')
+
+log_parser = imp.load_source ('log_parser', LOG_PARSER)
+
+class SyntheticLog(object):
+    '''Read-only file object with "count" CASE messages of "msg_size"
+    characters each, preceded by some console output. Generated as it is
+    read, so large logs don't take memory.'''
+    def __init__(self, count, msg_size):
+        self.count = count
+        self.msg_size = msg_size
+        self.index = -1
+        self.pending = ''
+
+    def _next_chunk(self):
+        if self.index < 0:
+            chunk = '{}CASE_ENUM {}{}\n'.format(
+                log_parser.OPEN_MSG,
+                ' '.join ('c{}'.format (i) for i in range (self.count)),
+                log_parser.CLOSE_MSG)
+        else:
+            prefix = 'CASE c{} FAIL '.format (self.index)
+            chunk = 'console output\r\n{}{}{}{}\n'.format(
+                log_parser.OPEN_MSG,
+                prefix,
+                'x' * (self.msg_size - len (prefix)),
+                log_parser.CLOSE_MSG)
+        self.index += 1
+        return chunk
+
+    def read(self, size):
+        while len (self.pending) < size and self.index < self.count:
+            self.pending += self._next_chunk()
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+class IterMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.fill = log_parser._LogReader.fill
+        self.peak = 0
+        test = self
+
+        def fill(reader):
+            ret = test.fill (reader)
+            test.peak = max (test.peak, len (reader.buf))
+            return ret
+        log_parser._LogReader.fill = fill
+
+    def tearDown(self):
+        log_parser._LogReader.fill = self.fill
+
+    def test_buffer_bounded(self):
+        '''The read buffer holds about the largest message plus a block,
+        however big the log and wherever the messages straddle the blocks.'''
+        count = 20000
+        msg_size = 4000
+        blocksize = 64 * 1024
+        messages = 0
+        largest = 0
+        for msg in log_parser.iter_messages(
+                SyntheticLog (count, msg_size), blocksize):
+            if messages > 0:
+                self.assertEqual (len (msg), msg_size)
+                self.assertTrue (msg.startswith ('CASE c{} '.format (messages - 1)))
+            messages += 1
+            largest = max (largest, len (msg))
+
+        self.assertEqual (messages, count + 1)
+        self.assertLess (self.peak, blocksize + 2 * largest)
+
+    def test_split_lines(self):
+        log = (
+            'x{0}not a message{1}\n'
+            '{0}multi\r\nline\rmessage{1}\r\n'
+            '{0}last{1}').format (log_parser.OPEN_MSG, log_parser.CLOSE_MSG)
+        for blocksize in (1, 2, 7, 1024):
+            self.assertEqual(
+                list (log_parser.iter_messages (io.BytesIO (log), blocksize)),
+                ['multilinemessage', 'last'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Tests helpers of the sync tool ("sync.py"). Run with:
+
+    python scripts/test/test_sync.py
+'''
+import sys
+import unittest
+from os import path
+
+TEST_DIR = path.dirname (path.realpath (__file__))
+sys.path.insert (0, path.join (path.dirname (TEST_DIR), 'cli'))
+from sync import xml_hash
+
+class XmlHashTest(unittest.TestCase):
+    def assertSameHash(self, a, b):
+        self.assertEqual (xml_hash (a), xml_hash (b))
+
+    def assertDifferentHash(self, a, b):
+        self.assertNotEqual (xml_hash (a), xml_hash (b))
+
+    def test_formatting_ignored(self):
+        self.assertSameHash(
+            '<?xml version="1.1" encoding="UTF-8"?>\n'
+                '<project>\n  <a x="1" y="2">v</a>\n  <b/>\n</project>\n',
+            '<project><a y="2" x="1">v</a><b></b></project>')
+
+    def test_leaf_whitespace_kept(self):
+        self.assertDifferentHash(
+            '<p><defaultValue> </defaultValue></p>',
+            '<p><defaultValue></defaultValue></p>')
+        self.assertDifferentHash (
+            '<p><command>\n</command></p>', '<p><command/></p>')
+
+    def test_mixed_content_kept(self):
+        self.assertDifferentHash ('<p><a/>text</p>', '<p><a/></p>')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018 HMS Industrial Networks AB
+#
+# This program is the property of HMS Industrial Networks AB.
+# It may not be reproduced, distributed, or used without permission
+# of an authorized company official.
+
+'''
+Tests "uboot-boot-and-login.py" and the U-Boot controller against fake U-Boot
+shells on pseudo terminals ("fake_uboot.py"). Run with:
+
+    python scripts/test/test_uboot_controller.py
+'''
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+from os import path
+
+TEST_DIR = path.dirname (path.realpath (__file__))
+JENKINS_HOME_DIR = path.join (path.dirname (TEST_DIR), 'jenkins-home')
+FAKE_UBOOT = path.join (TEST_DIR, 'fake_uboot.py')
+BOOT_AND_LOGIN = path.join (JENKINS_HOME_DIR, 'uboot-boot-and-login.py')
+CONTROLLER = path.join (JENKINS_HOME_DIR, 'uboot_controller.py')
+
+sys.path.insert (0, JENKINS_HOME_DIR)
+from uboot_controller import CONTROLLER_SOCKET_ENV
+
+# Upper bound (seconds) for any process started by the tests.
+PROCESS_TIMEOUT = 60
+
+def wait_process(proc, timeout=PROCESS_TIMEOUT):
+    '''Returns the exit status of "proc", killing it if it takes longer than
+    "timeout".'''
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            proc.kill()
+            proc.wait()
+            raise AssertionError ('process timed out: {}'.format (proc.args))
+        time.sleep (0.05)
+    return proc.returncode
+
+class Process(subprocess.Popen):
+    def __init__(self, args, **kwargs):
+        subprocess.Popen.__init__ (self, args, **kwargs)
+        self.args = args
+
+class UbootTestCase(unittest.TestCase):
+    '''Starts fake U-Boot shells on demand and kills them after each test.'''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp (prefix='hottest-test-')
+        self.processes = []
+
+    def tearDown(self):
+        for proc in reversed (self.processes):
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        shutil.rmtree (self.tmpdir)
+
+    def start(self, args, **kwargs):
+        proc = Process (args, **kwargs)
+        self.processes.append (proc)
+        return proc
+
+    def start_fake_uboot(self, *args):
+        '''Returns the terminal path of a new fake U-Boot.'''
+        proc = self.start(
+            [sys.executable, FAKE_UBOOT] + list (args), stdout=subprocess.PIPE)
+        return proc.stdout.readline().strip()
+
+    def start_boot(
+            self, serial_dev, boot_cmd='boot', timeout=10, env=None,
+            extra_args=[]):
+        '''Starts "uboot-boot-and-login.py" with its output on a file. Returns
+        (process, output filename).'''
+        output = path.join(
+            self.tmpdir, 'boot-{}.out'.format (len (self.processes)))
+        with open (output, 'w') as f:
+            proc = self.start(
+                [sys.executable,
+                    BOOT_AND_LOGIN,
+                    '-s', serial_dev,
+                    '-l', 'login: ',
+                    '-t', str (timeout),
+                    '-c', boot_cmd] + extra_args,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+                env=env)
+        return proc, output
+
+    def boot(self, serial_dev, boot_cmd='boot', env=None, extra_args=[]):
+        '''Runs "uboot-boot-and-login.py". Returns (status, output).'''
+        proc, output = self.start_boot(
+            serial_dev, boot_cmd, env=env, extra_args=extra_args)
+        status = wait_process (proc)
+        with open (output) as f:
+            return status, f.read()
+
+class BootAndLoginTest(UbootTestCase):
+    def setUp(self):
+        super (BootAndLoginTest, self).setUp()
+        self.env = dict (os.environ)
+        self.env.pop (CONTROLLER_SOCKET_ENV, None)
+
+    def test_login(self):
+        status, output = self.boot (self.start_fake_uboot(), env=self.env)
+        self.assertEqual (status, 0, output)
+        self.assertIn ('buildroot login: ', output)
+
+    def test_late_echo(self):
+        status, output = self.boot(
+            self.start_fake_uboot ('--echo-delay', '0.3'), env=self.env)
+        self.assertEqual (status, 0, output)
+
+    def test_kernel_panic(self):
+        status, output = self.boot(
+            self.start_fake_uboot(),
+            'setenv bootend Kernel panic - not syncing; boot',
+            env=self.env)
+        self.assertEqual (status, 1, output)
+        self.assertIn ('Boot failed: kernel panic', output)
+
+    def test_fail_match(self):
+        # Groups of their own don't interfere with the built-in targets.
+        status, output = self.boot(
+            self.start_fake_uboot(),
+            env=self.env,
+            extra_args=[
+                '--fail-match', r'(?P<line>line) (1)\2\b',
+                '--fail-match', 'never seen'])
+        self.assertEqual (status, 1, output)
+        self.assertIn(
+            'Boot failed: failure match: "(?P<line>line) (1)\\2\\b"', output)
+
+    def test_invalid_fail_match(self):
+        status, output = self.boot(
+            self.start_fake_uboot(), env=self.env, extra_args=['-f', '(x'])
+        self.assertEqual (status, 2, output)
+        self.assertIn ('invalid regular expression', output)
+        self.assertNotIn ('waiting for U-boot shell', output)
+
+class ControllerTest(UbootTestCase):
+    def setUp(self):
+        super (ControllerTest, self).setUp()
+        self.socket = path.join (self.tmpdir, 'controller.sock')
+        self.log_dir = path.join (self.tmpdir, 'logs')
+        os.mkdir (self.log_dir)
+        with open (path.join (self.tmpdir, 'controller.out'), 'w') as f:
+            self.start(
+                [sys.executable,
+                    CONTROLLER,
+                    '--socket', self.socket,
+                    '--log-dir', self.log_dir],
+                stdout=f,
+                stderr=subprocess.STDOUT)
+        deadline = time.time() + PROCESS_TIMEOUT
+        while not path.exists (self.socket):
+            self.assertLess (time.time(), deadline, 'controller not started')
+            time.sleep (0.05)
+        self.env = dict (os.environ)
+        self.env[CONTROLLER_SOCKET_ENV] = self.socket
+
+    def read_log(self, serial_dev):
+        with open (path.join (self.log_dir, path.basename (serial_dev) + '.log')) as f:
+            return f.read()
+
+    def test_concurrent_boots(self):
+        ports = [self.start_fake_uboot() for _ in range (4)]
+        boots = [self.start_boot (port, env=self.env) for port in ports]
+        for port, (proc, output) in zip (ports, boots):
+            with open (output) as f:
+                self.assertEqual (wait_process (proc), 0, f.read())
+            self.assertIn ('buildroot login: ', self.read_log (port))
+
+    def test_kernel_panic(self):
+        status, output = self.boot(
+            self.start_fake_uboot(),
+            'setenv bootend Kernel panic - not syncing; boot',
+            env=self.env)
+        self.assertEqual (status, 1, output)
+        self.assertIn ('Boot failed: kernel panic', output)
+
+    def test_fail_match(self):
+        status, output = self.boot(
+            self.start_fake_uboot(),
+            env=self.env,
+            extra_args=['--fail-match', r'(?P<line>line) (1)\2\b'])
+        self.assertEqual (status, 1, output)
+        self.assertIn ('Boot failed: failure match', output)
+
+    def test_busy_port(self):
+        port = self.start_fake_uboot()
+        proc, _ = self.start_boot (port, 'slow 2; boot', env=self.env)
+        time.sleep (1)
+        status, output = self.boot (port, env=self.env)
+        self.assertEqual (status, 1, output)
+        self.assertIn ('port already in use', output)
+        self.assertEqual (wait_process (proc), 0)
+
+    def test_stuck_client(self):
+        '''A client that doesn't read its replies doesn't stall the boots of
+        other clients.'''
+        stuck_port = self.start_fake_uboot()
+        conn = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect (self.socket)
+        request = {
+            'serial_dev' : stuck_port,
+            'baudrate' : 115200,
+            'boot_cmd' : 'setenv chatter 100000; boot',
+            'login_match' : 'login: ',
+            'user' : 'root',
+            'timeout' : 30,
+            'uboot_connect_timeout' : 10,
+        }
+        try:
+            conn.sendall (json.dumps (request) + '\n')
+            time.sleep (1) # Let the stuck client's boot start first
+
+            start = time.time()
+            status, output = self.boot (self.start_fake_uboot(), env=self.env)
+            self.assertEqual (status, 0, output)
+            self.assertLess (time.time() - start, 10)
+        finally:
+            conn.close()
+
+        deadline = time.time() + PROCESS_TIMEOUT
+        while 'buildroot login: ' not in self.read_log (stuck_port):
+            self.assertLess (time.time(), deadline, 'stuck client boot not done')
+            time.sleep (0.1)
+
+if __name__ == '__main__':
+    unittest.main()